@@ -3,23 +3,88 @@
 # Released under the GNU General Public License, v3.0 or later
 # Copyright (c) 2007 Phil Jones <interstar@gmail.com>
 
+import time
+from optparse import OptionParser
+
 from libs.interpreter import *
 
 version = '0.3.5'
 
-if __name__ == '__main__' :
-    fName = argv[1]
-    oDir = argv[2]
-    if len(argv) > 3 :
-        packages = [argv[3]]
-    else :
-        packages = []
-    print "GeekWeaver version %s" % version 
-    print 'Copyright Phil Jones 2007-2013'
-    print 'This code is released under the Gnu General Public License, version 3.0 or higher'
+def makeOptionParser() :
+    p = OptionParser(usage='%prog [options] source.opml outputDir [package ...]', version=version)
+    p.add_option('--cache', dest='cacheDir', default=None, metavar='DIR',
+                 help='keep parsed OPML trees in DIR and reuse them while the files are unchanged')
+    p.add_option('--compile', dest='compileBlocks', action='store_true', default=False,
+                 help='compile block bodies into Python closures the first time they are called')
+    p.add_option('--memo', dest='memoBlocks', action='store_true', default=False,
+                 help='remember the results of pure block calls and reuse them for the same arguments')
+    p.add_option('--stream', dest='streamPages', action='store_true', default=False,
+                 help='write each page to its file while it is evaluated, instead of keeping them all until the end')
+    p.add_option('--log-level', dest='logLevel', default='info', choices=['trace', 'debug', 'info', 'warn', 'error'],
+                 help='the least important messages to keep in log.html : trace, debug, info (the default, the stages of the build and :log lines), warn or error')
+    p.add_option('--log-tail', dest='logTail', type='int', default=1000, metavar='N',
+                 help='keep only the last N messages in memory for log.html')
+    p.add_option('--log-stream', dest='logStream', action='store_true', default=False,
+                 help='write log.html as the build goes, instead of at the end')
+    p.add_option('--log-jsonl', dest='logJsonl', default=None, metavar='FILE',
+                 help='also write every message to FILE, as a JSON object per line')
+    p.add_option('--log-stderr', dest='logStderr', action='store_true', default=False,
+                 help='also print every message to stderr')
+    p.add_option('--snapshots', dest='snapshots', type='int', default=0, metavar='N',
+                 help='keep the last N symbol table snapshots from block calls, in symtables.html')
+    p.add_option('--snapshot-every', dest='snapshotEvery', type='int', default=1, metavar='N',
+                 help='only snapshot every Nth block call')
+    p.add_option('--snapshot-blocks', dest='snapshotBlocks', default=None, metavar='NAMES',
+                 help='only snapshot calls to these blocks (comma separated)')
+    p.add_option('--profile', dest='profile', action='store_true', default=False,
+                 help='time block calls and pages, and write profile.json and profile.html with the site')
+    p.add_option('--flame', dest='flame', action='store_true', default=False,
+                 help='as --profile, and also write the stacks of pages, blocks, modes and :for loops in collapsed stack format (profile.time.folded and profile.bytes.folded) for flame graphs')
+    p.add_option('--incremental', dest='incremental', action='store_true', default=False,
+                 help='build over an existing output directory, re-rendering only the pages whose inputs changed')
+    p.add_option('--keep-unchanged', dest='keepUnchanged', action='store_true', default=False,
+                 help='build over an existing output directory, leaving pages whose content has not changed untouched')
+    p.add_option('--prune', dest='prune', action='store_true', default=False,
+                 help='delete the pages of the last build which are no longer in the outline')
+    p.add_option('--jobs', dest='jobs', type='int', default=1, metavar='N',
+                 help='render pages in N worker processes')
+    p.add_option('--serial-pages', dest='serialPages', default=None, metavar='NAMES',
+                 help='pages to render in order, in the main process, with --jobs (comma separated)')
+    p.add_option('--writer-threads', dest='writerThreads', type='int', default=0, metavar='N',
+                 help='write the pages on N threads, through a bounded queue')
+    p.add_option('--fsync', dest='fsync', action='store_true', default=False,
+                 help='with --writer-threads, fsync each page as it is written')
+    p.add_option('--sync', dest='sync', default=None, metavar='MODE', choices=list(SYNC_MODES),
+                 help='build over an existing output directory, copying templates and assets only where they have changed. MODE is copy, hardlink or symlink')
+    p.add_option('--sync-hash', dest='syncHash', action='store_true', default=False,
+                 help='with --sync copy, compare the content of files whose mtimes differ')
+    p.add_option('--sync-threads', dest='syncThreads', type='int', default=1, metavar='N',
+                 help='with --sync, sync files on N threads')
+    p.add_option('--watch', dest='watch', action='store_true', default=False,
+                 help='keep running, and build again (incrementally) whenever the source or a file it uses changes')
+    p.add_option('--poll', dest='poll', action='store_true', default=False,
+                 help='with --watch, look for changes every half second, instead of using inotify')
+    p.add_option('--serve', dest='serve', type='int', default=None, metavar='PORT',
+                 help='as --watch, and serve the output directory at http://127.0.0.1:PORT/ for previews')
+    p.add_option('--iterative', dest='iterative', action='store_true', default=False,
+                 help='evaluate with an explicit stack instead of recursion, so deep outlines do not hit the recursion limit')
+    return p
 
-    f = InterpreterFactory()
+def build(options, fName, oDir, packages, treeCache=None) :
+    f = InterpreterFactory(options.logTail)
     log = f.getLogger()
+    log.level = LEVELS[options.logLevel]
+    if options.logStream :
+        log.addSink(HtmlSink('log.html'))
+    if options.logJsonl :
+        log.addSink(JsonlSink(options.logJsonl))
+    if options.logStderr :
+        log.addSink(StderrSink())
+    if options.snapshots > 0 :
+        blocks = None
+        if options.snapshotBlocks :
+            blocks = set([x.strip() for x in options.snapshotBlocks.split(',')])
+        log.snapshots = Snapshots(options.snapshots, options.snapshotEvery, blocks)
 
     print "Creating site from %s" % fName
     print "in directory %s" % oDir
@@ -30,6 +95,91 @@ if __name__ == '__main__' :
     log.log('<i>This code is released under the Gnu General Public License, version 3.0 or higher</i>','html')
     log.log('Starting ...')
     i = f.getInterpreter()
+    if treeCache is not None :
+        treeCache.log = log
+        i.treeCache = treeCache
+    elif options.cacheDir :
+        i.treeCache = TreeCache(options.cacheDir, log)
+    i.compileBlocks = options.compileBlocks
+    if options.memoBlocks :
+        i.blockMemo = BlockMemo()
+    i.streamPages = options.streamPages
+    if options.profile or options.flame :
+        i.profiler = Profiler(flame=options.flame)
+    if options.iterative :
+        i.evaluator = StackEvaluator()
+    if options.incremental :
+        i.incremental = IncrementalBuild()
+    if options.jobs > 1 :
+        serial = []
+        if options.serialPages :
+            serial = [x.strip() for x in options.serialPages.split(',')]
+        i.pagePool = PagePool(options.jobs, serial)
+    sm = f.getSiteMapper()
+    sm.keepUnchanged = options.keepUnchanged
+    sm.prune = options.prune
+    if options.sync :
+        i.sync = TreeSync(options.sync, options.syncHash, options.syncThreads)
+    if options.writerThreads > 0 :
+        sm.writer = BulkWriter(options.writerThreads, fsync=options.fsync)
     i.runFile(fName, oDir, packages)
     i.getLog().htmlFile('log.html')
+    if i.sync is not None :
+        print i.sync.summary()
+    if sm.writer is not None :
+        print sm.writer.summary()
+    if sm.outputs is not None :
+        print sm.summary()
     print 'Compilation finished'
+    return i
+
+def watch(options, fName, oDir, packages) :
+    """ build, and build again whenever one of the files the build read changes """
+    # each build starts from a fresh interpreter, but only re-renders the pages (and
+    # copies the files) which changed, and re-reads only the OPML files which changed
+    options.incremental = True
+    options.keepUnchanged = True
+    if not options.sync :
+        options.sync = 'copy'
+    under = None
+    if options.cacheDir :
+        under = TreeCache(options.cacheDir)
+    treeCache = MemoryTreeCache(under)
+    if options.serve is not None :
+        server = PreviewServer(oDir, options.serve)
+        server.start()
+        print 'Serving %s at %s' % (oDir, server.url())
+    watcher = makeWatcher(options.poll)
+    inputs = set([fName])
+    while True :
+        started = time.time()
+        try :
+            i = build(options, fName, oDir, packages, treeCache)
+            inputs = i.inputs | set([fName])
+            print i.incremental.summary()
+            print treeCache.summary()
+        except Exception, e :
+            # keep watching what the last good build read, and try again after the next change
+            print 'Build failed : %s' % e
+        print 'Built in %.2f s, watching %s files (Ctrl-C to stop)' % (time.time() - started, len(inputs))
+        watcher.watch(inputs)
+        try :
+            changed = watcher.wait()
+        except KeyboardInterrupt :
+            break
+        print 'Changed : %s' % ', '.join(changed)
+    watcher.close()
+
+if __name__ == '__main__' :
+    (options, args) = makeOptionParser().parse_args()
+    fName = args[0]
+    oDir = args[1]
+    packages = args[2:]
+    print "GeekWeaver version %s" % version 
+    print 'Copyright Phil Jones 2007-2013'
+    print 'This code is released under the Gnu General Public License, version 3.0 or higher'
+
+    if options.watch or options.serve is not None :
+        watch(options, fName, oDir, packages)
+    else :
+        build(options, fName, oDir, packages)
@@ -5,28 +5,28 @@
 SymbolTable is a dictionary of stacks (lists)
 """
 
+MISSING = object() # a default for lookup which can't be mistaken for a value
+
 class SymbolTableException(Exception):
     def __init__(self, msg, frame, key) :
         self.msg = msg
         self.frame = frame
         self.key = key
-                 
+
 class SymbolFrame :
     """ One frame (dictionary) binding names to values"""
     def __init__(self,d={},parent=None,depth=0) :
         self.d = d
         self.parent = parent
         self.depth = depth
+        self.defs = {} # blocks defined while this was the innermost frame
+        self.names = [] # the undo log : names this frame has bound
 
     def get(self,k) :
-        if self.d.has_key(k) :
-            return self.d[k]
-        else :
-            if self.parent :
-                return self.parent.get(k)
-            else :
-                
-                raise SymbolTableException("Key Not Defined",self,k)
+        """ k as bound by this frame alone """
+        if k in self.defs :
+            return self.defs[k]
+        return self.d[k]
 
     def __str__(self) :
         return "SymbolFrame depth %s" % self.depth
@@ -36,38 +36,124 @@ class SymbolFrame :
 <td valign='top'>%s</td><td valign='top'>%s</td>
 <td valign='top'>
 <table border='1'>""" % (self.depth, self.parent)
-        for k in self.d.keys() :
-            v = '%s' % self.d[k]
+        for k, v in self.d.items() + self.defs.items() :
+            # (items, so that unevaluated args of an ArgBlock aren't forced just for the log)
+            v = '%s' % v
             v = v.replace('<','&lt;')
             s = s + '<tr><td>%s</td><td>%s</td></tr>\n' % (k,v)
         s = s + """</table>
 </td></tr>
 """
         return s
-    
+
 class SymbolTable :
-    """ New version of the symbol table in terms of a 'stack' or 'tree' of SymbolFrames """
-    
+    """ New version of the symbol table in terms of a 'stack' of SymbolFrames, indexed by name """
+
     def __init__(self, d = {}) :
         # symbol table always starts with one frame, empty if dict not specified
-        self.stack = [SymbolFrame(d,None,0)]
-        
+        self.stack = []
+        self.bindings = {} # name -> the dictionaries which bind it, innermost last
+        self.misses = {} # name -> how many times it was looked for and not found
+        self.reads = None # a set, to record the names looked up
+        self.pushFrame(d)
+
     def get(self, k) :
-        return self.stack[-1].get(k)
-    
+        if self.reads is not None :
+            self.reads.add(k)
+        ds = self.bindings.get(k)
+        if ds :
+            return ds[-1][k]
+        self.missed(k)
+        raise SymbolTableException("Key Not Defined",self.stack[-1],k)
+
+    def lookup(self, k, default=None) :
+        """ the value of k, or default if it isn't bound """
+        if self.reads is not None :
+            self.reads.add(k)
+        ds = self.bindings.get(k)
+        if ds :
+            return ds[-1][k]
+        self.missed(k)
+        return default
+
+    def has(self, k) :
+        if self.reads is not None :
+            self.reads.add(k)
+        if self.bindings.get(k) :
+            return True
+        self.missed(k)
+        return False
+
+    def missed(self, k) :
+        self.misses[k] = self.misses.get(k, 0) + 1
+
+    def missSummary(self, n=20) :
+        """ the n symbols most often not found, for the log """
+        worst = sorted(self.misses.items(), key=lambda x : (-x[1], x[0]))[:n]
+        return 'symbols not found : %s' % ', '.join(['%s (%s)' % x for x in worst])
+
     def pushFrame(self, d) :
         # We're going to assume that the d which is pushed into the SymbolTable is
         # actually an ArgBlock rather than a dictionary (although it is a sub-class of dict)
-        
-        if len(self.stack) > 1 :
+        if self.stack :
             parent = self.stack[-1]
             sf = SymbolFrame(d,parent, parent.depth+1)
         else :
             sf = SymbolFrame(d,None,0)
+        self.bind(sf)
+
+    def bind(self, sf) :
+        bindings = self.bindings
+        for k in sf.d.keys() :
+            if k in bindings :
+                bindings[k].append(sf.d)
+            else :
+                bindings[k] = [sf.d]
+            sf.names.append(k)
+        for k, v in sf.defs.items() :
+            # (only frames put back by restore have defs already)
+            del sf.defs[k]
+            self.defineIn(sf, k, v)
         self.stack.append(sf)
-        
+
     def popFrame(self) :
-        self.stack.pop()
+        sf = self.stack.pop()
+        bindings = self.bindings
+        for k in sf.names :
+            bindings[k].pop()
+        del sf.names[:]
+
+    def define(self, k, v) :
+        """ bind k to v in the innermost frame (as ::block definitions do) """
+        self.defineIn(self.stack[-1], k, v)
+
+    def defineIn(self, sf, k, v) :
+        defs = sf.defs
+        if k in defs :
+            defs[k] = v
+            return
+        defs[k] = v
+        if k in sf.d :
+            # the frame's own binding of k is the innermost one, so replace it
+            self.bindings[k][-1] = defs
+        else :
+            if k in self.bindings :
+                self.bindings[k].append(defs)
+            else :
+                self.bindings[k] = [defs]
+            sf.names.append(k)
+
+    def setAside(self, depth) :
+        """ pop the frames above depth, and return them so they can be restored """
+        above = self.stack[depth:]
+        for x in above :
+            self.popFrame()
+        return above
+
+    def restore(self, above) :
+        """ push back the frames that setAside returned """
+        for sf in above :
+            self.bind(sf)
 
     def getCurrentLineArgs(self) :
         return self.stack[-1].d.lineArgs
@@ -85,7 +171,7 @@ class SymbolTable :
 
     def __str__(self) :
         return "Symbol Table"
-   
+
     def html(self) :
         return """<h3>Symbol Table</h3>
 <table border='2'>
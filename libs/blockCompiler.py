@@ -0,0 +1,70 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Compiles the body of a CBlock into Python closures, once per mode.
+"""
+
+from gwNode import nodeSyntax, TEXT, COMMENT
+
+
+def constant(v) :
+    def f(fellow) :
+        return v
+    f.isConstant = True
+    f.value = v
+    return f
+
+def isConstant(f) :
+    return getattr(f, 'isConstant', False)
+
+
+class BlockCompiler :
+
+    def __init__(self, mode) :
+        self.mode = mode
+
+    def compilerFor(self, mode) :
+        if mode is self.mode :
+            return self
+        return BlockCompiler(mode)
+
+    def compileBody(self, body) :
+        """ a function of fellow that returns the same as mode.jFact(fellow)(body) """
+        mode = self.mode
+        kids = [self.compileNode(x) for x in body.children]
+        def run(fellow) :
+            f = fellow.inc()
+            return mode.sJoin([k(f) for k in kids])
+        return run
+
+    def compileNode(self, node) :
+        mode = self.mode
+        syn = nodeSyntax(node)
+        if not syn.dynamic :
+            if syn.kind == COMMENT :
+                return constant('')
+            if syn.kind == TEXT and mode.compilable :
+                shape = mode.staticShape(node)
+                if shape is not None :
+                    return self.compileShape(shape, node)
+
+        def interpret(fellow) :
+            return mode.evalNode(node, fellow)
+        return interpret
+
+    def compileShape(self, shape, node) :
+        if not shape.children :
+            return constant(shape.render([]))
+
+        c = self.compilerFor(shape.childMode or self.mode)
+        kids = [c.compileNode(x) for x in node.children]
+        if all([isConstant(k) for k in kids]) :
+            return constant(shape.render([k.value for k in kids]))
+
+        inc = shape.inc
+        def run(fellow) :
+            if inc :
+                fellow = fellow.inc()
+            return shape.render([k(fellow) for k in kids])
+        return run
@@ -0,0 +1,177 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Memoisation of pure block calls (those which only depend on their arguments).
+"""
+
+import re
+
+from gwNode import GWNode, lineKind, isDynamic, LexLine, PYTHON, DEFINE, CALL, MAP, FOR
+
+SYMBOL = re.compile(r'\$(?:\{([A-Za-z0-9_\s]+)\}|\/?([A-Za-z0-9_]+))')
+
+
+def symbolsIn(s) :
+    """ the names of the symbols that evalSymbols would look up in s """
+    names = set()
+    if s[:1] == '#' :
+        names.add(s[1:].strip())
+    for braced, name in SYMBOL.findall(s) :
+        names.add(braced or name)
+    return names
+
+
+class Purity :
+
+    """ what we know about a block body : whether it's pure and which symbols it uses """
+
+    def __init__(self) :
+        self.pure = True
+        self.reason = ''
+        self.symbols = set()
+
+    def names(self) :
+        return tuple(sorted(self.symbols))
+
+    def impure(self, reason) :
+        if self.pure :
+            self.pure = False
+            self.reason = reason
+
+    def analyseTree(self, node, bound=frozenset()) :
+        for child in node.children :
+            self.analyseLine(child, bound)
+            if not self.pure :
+                break
+        return self
+
+    def analyseLine(self, node, bound) :
+        t = node.text
+        kind = lineKind(t)
+        if kind == PYTHON :
+            return self.impure('runs python : %s' % t)
+        if kind == DEFINE :
+            return self.impure('defines a block : %s' % t)
+        if kind in (CALL, MAP) :
+            if t[:5] == ':copy' or t[:4] == ':csv' :
+                return self.impure('reads or copies files : %s' % t)
+            return self.impure('calls a block : %s' % t)
+
+        if kind == FOR :
+            ll = LexLine(t, ':')
+            if len(ll.args) < 2 :
+                return self.impure('has a :for without a list : %s' % t)
+            localName = ll.args[0]
+            listName = ll.args[1]
+            if listName[0] == '#' :
+                listName = listName[1:]
+            self.uses(set([listName]), bound)
+            bound = bound | frozenset([localName])
+        elif isDynamic(t) :
+            self.uses(symbolsIn(t), bound)
+
+        self.analyseTree(node, bound)
+
+    def uses(self, names, bound) :
+        self.symbols.update([n for n in names if not n in bound])
+
+    def analyseTemplate(self, s) :
+        if not isinstance(s, basestring) :
+            return self.impure('template is not a string')
+        self.symbols.update(symbolsIn(s))
+        return self
+
+
+def canonical(v) :
+    """ a hashable value which is equal for equal arguments, or None if v can't be compared """
+    if isinstance(v, basestring) :
+        return (v.__class__, v)
+    if v.__class__ is GWNode :
+        if not isinstance(v.text, basestring) or isDynamic(v.text) :
+            # evaluating it would look up symbols from wherever the block is called
+            return None
+        kids = []
+        for x in v.children :
+            k = canonical(x)
+            if k is None :
+                return None
+            kids.append(k)
+        return ('node', v.text, tuple(kids))
+    if v is None or isinstance(v, (int, long, float)) :
+        return (v.__class__, v)
+    return None
+
+
+class BlockMemo :
+
+    def __init__(self) :
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def purityOf(self, block, mode) :
+        if block.purity is None :
+            block.purity = block.analyse()
+            if not block.purity.pure :
+                mode.debug('block memo : %s is not cacheable, it %s', block.name, block.purity.reason)
+        return block.purity
+
+    def key(self, block, argBlock, mode, names) :
+        args = []
+        for name in names :
+            if not name in argBlock :
+                return None # a free symbol
+            v = canonical(argBlock[name])
+            if v is None :
+                return None
+            args.append((name, v))
+        # [[ links depend on the site root, which is made from these
+        interpreter = mode.environment.interpreter
+        root = (interpreter.codedSiteRoot, getattr(interpreter, 'dName', None))
+        return (block, mode, root, tuple(args))
+
+    def prepare(self, block, argBlock, mode) :
+        """ the key for this call, or None (counted as uncached) if it can't be memoised """
+        purity = None
+        if not mode.makesPages :
+            purity = self.purityOf(block, mode)
+        key = None
+        if purity is not None and purity.pure :
+            key = self.key(block, argBlock, mode, block.keyNames(argBlock, purity))
+        if key is None :
+            self.uncached = self.uncached + 1
+        return key
+
+    def recall(self, key, block, mode) :
+        """ (True, the result) if we've seen this call before, otherwise (False, None) """
+        if key in self.table :
+            self.hits = self.hits + 1
+            mode.trace('block memo hit : %s (hits %s, misses %s)', block.name, self.hits, self.misses)
+            return True, self.table[key]
+        self.misses = self.misses + 1
+        mode.trace('block memo miss : %s (hits %s, misses %s)', block.name, self.hits, self.misses)
+        return False, None
+
+    def remember(self, key, rVal, depth, symbolTable) :
+        """ keep rVal, if it's a string and the call left the symbol table at depth """
+        if len(symbolTable) == depth and isinstance(rVal, basestring) :
+            self.table[key] = rVal
+
+    def call(self, block, argBlock, mode, fellow) :
+        key = self.prepare(block, argBlock, mode)
+        if key is None :
+            return block.evaluate(argBlock, mode, fellow)
+        found, rVal = self.recall(key, block, mode)
+        if found :
+            return rVal
+        symbolTable = mode.environment.symbolTable
+        depth = len(symbolTable)
+        rVal = block.evaluate(argBlock, mode, fellow)
+        self.remember(key, rVal, depth, symbolTable)
+        return rVal
+
+    def summary(self) :
+        return 'block memo : %s hits, %s misses, %s calls not cacheable, %s results kept' % (
+            self.hits, self.misses, self.uncached, len(self.table))
@@ -1,8 +1,43 @@
 import re
-from gwNode import GWNode
+from gwNode import GWNode, nodeSyntax, DEFINE
 from string import Template
 
+from blockCompiler import BlockCompiler
+from blockMemo import Purity
+
 # Classes
+class Thunk(object) :
+
+    """
+    An argument which hasn't been evaluated yet, and the symbol table depth it was called at
+    """
+
+    __slots__ = ('f', 'symbolTable', 'depth')
+
+    def __init__(self, f, symbolTable) :
+        self.f = f
+        self.symbolTable = symbolTable
+        self.depth = len(symbolTable.stack)
+
+    def force(self) :
+        above = self.symbolTable.setAside(self.depth)
+        try :
+            return self.f()
+        finally :
+            self.symbolTable.restore(above)
+
+    def __str__(self) :
+        return '(not evaluated yet)'
+
+def definesBlocks(node) :
+    """ does this sub-tree define blocks (which has to happen where the call is) """
+    if nodeSyntax(node).kind == DEFINE :
+        return True
+    for x in node.children :
+        if definesBlocks(x) :
+            return True
+    return False
+
 class ArgBlock(dict) :
 
     """
@@ -16,8 +51,26 @@ class ArgBlock(dict) :
       and are mapped to $__0 , $__1 , $__2   etc.
     - anonChildren which are data are mapped to 
     There are also three lists : lineArgs, namedChildren, anonChildren so we can iterate through these groups
+    Named and anonymous children are Thunks, evaluated the first time they're looked up.
     """
 
+    def __getitem__(self, k) :
+        v = dict.__getitem__(self, k)
+        if v.__class__ is Thunk :
+            v = v.force()
+            dict.__setitem__(self, k, v)
+        return v
+
+    def get(self, k, default=None) :
+        if k in self :
+            return self[k]
+        return default
+
+    def later(self, child, f, mode) :
+        if definesBlocks(child) :
+            return f()
+        return Thunk(f, mode.environment.symbolTable)
+
     def getValOfArg(self, s) :
         if s[0] != '#' :
             return s
@@ -50,7 +103,7 @@ class ArgBlock(dict) :
     def setChildArgs(self, node, mode, fellow) :
         
         for child in node.children :
-            t = mode.evalSymbols(child.text,fellow)
+            t = mode.nodeText(child,fellow)
                 
             if t.find(':') > 0 :
                 # we are always going to eval the argument as a string here                
@@ -59,7 +112,8 @@ class ArgBlock(dict) :
 
                 # it's all strings 
                 joinChildren = mode.jFact(fellow)
-                val = joinChildren(child, parts[1].strip())
+                head = parts[1].strip()
+                val = self.later(child, lambda child=child, head=head : joinChildren(child, head), mode)
 
                 self.namedChildren.append(val)
                 self[key] = val
@@ -78,13 +132,18 @@ class ArgBlock(dict) :
                     
             else :
                 # this is going to be an anon arg (always treat as a string)
-                val = mode.evalNode(child,fellow)
+                val = self.later(child, lambda child=child : mode.evalNode(child,fellow), mode)
                 self.anonChildren.append(val)
 
-        self['__'] = GWNode('')
         for x in range(len(self.anonChildren)) :
             self['__%s'%x] = self.anonChildren[x]
-            self['__'].children.append(GWNode(self.anonChildren[x]))
+        self['__'] = Thunk(self.anonNode, mode.environment.symbolTable)
+
+    def anonNode(self) :
+        n = GWNode('')
+        for x in range(len(self.anonChildren)) :
+            n.children.append(GWNode(self['__%s'%x]))
+        return n
 
 
 
@@ -98,7 +157,7 @@ class ArgBlock(dict) :
         self.setChildArgs(node, mode, fellow)
 
 
-    def getAnonChildren(self) : return self.anonChildren
+    def getAnonChildren(self) : return [self['__%s'%x] for x in range(len(self.anonChildren))]
     
 def nullArgBlock() :
     return ArgBlock(GWNode(''),BaseMode(), nullFellowTraveller() ,Logger())
@@ -112,19 +171,52 @@ class CBlock :
         self.name = name
         self.body = tree
         self.frame = frame # we'll make this a closure in the future
+        self.compiled = {} # mode -> the body compiled for that mode
+        self.purity = None # worked out by the BlockMemo, the first time it's needed
+
+    def analyse(self) :
+        return Purity().analyseTree(self.body)
+
+    def keyNames(self, argBlock, purity) :
+        # only the arguments the body uses
+        return purity.names()
+
+    def compiledFor(self, mode) :
+        if not mode in self.compiled :
+            mode.debug('compiling block %s', self.name)
+            self.compiled[mode] = BlockCompiler(mode).compileBody(self.body)
+        return self.compiled[mode]
 
     def call(self, argBlock, mode, fellow) :
+        profiler = mode.environment.interpreter.profiler
+        if profiler is not None :
+            return profiler.call('block', self.name, self.run, argBlock, mode, fellow)
+        return self.run(argBlock, mode, fellow)
+
+    def run(self, argBlock, mode, fellow) :
+        memo = mode.environment.interpreter.blockMemo
+        if memo is not None :
+            return memo.call(self, argBlock, mode, fellow)
+        return self.evaluate(argBlock, mode, fellow)
+
+    def evaluate(self, argBlock, mode, fellow) :
+        snap = mode.snapshotWanted(self.name)
         mode.pushFrameToSymbolTable(argBlock)
-        mode.log('Pushed to SymbolTable')
-        mode.log(mode.environment.symbolTable,'symTable')
+        mode.trace('Pushed to SymbolTable')
+        if snap :
+            mode.snapshot('called %s' % self.name)
 
-        joinChildren = mode.jFact(fellow)
-        rVal = joinChildren(self.body)            
+        if mode.compilable and mode.environment.interpreter.compileBlocks :
+            rVal = self.compiledFor(mode)(fellow)
+        else :
+            joinChildren = mode.jFact(fellow)
+            rVal = joinChildren(self.body)            
 
+        if snap :
+            mode.snapshot('returning from %s' % self.name)
         mode.popFrameFromSymbolTable()
-        mode.log('Pop From SymbolTable')
-        mode.log(mode.environment.symbolTable,'symTable')
-        mode.log('return value (rVal) is %s' % rVal)
+        mode.trace('Pop From SymbolTable')
+        mode.trace('return value (rVal) is %s', rVal)
         
         return rVal
 
@@ -137,20 +229,42 @@ class CTemplate :
         self.name = name
         self.body = tString
         self.frame = frame
+        self.purity = None
+
+    def analyse(self) :
+        return Purity().analyseTemplate(self.body)
+
+    def keyNames(self, argBlock, purity) :
+        # the whole ArgBlock, as the template substitutes from it after evalSymbols
+        return sorted(set(argBlock.keys()) | purity.symbols)
 
-        
     def call(self, argBlock, mode, fellow) :
+        profiler = mode.environment.interpreter.profiler
+        if profiler is not None :
+            return profiler.call('block', self.name, self.run, argBlock, mode, fellow)
+        return self.run(argBlock, mode, fellow)
+
+    def run(self, argBlock, mode, fellow) :
+        memo = mode.environment.interpreter.blockMemo
+        if memo is not None :
+            return memo.call(self, argBlock, mode, fellow)
+        return self.evaluate(argBlock, mode, fellow)
+        
+    def evaluate(self, argBlock, mode, fellow) :
+        snap = mode.snapshotWanted(self.name)
         mode.pushFrameToSymbolTable(argBlock)
-        mode.log('Pushed to SymbolTable')
-        mode.log(mode.environment.symbolTable,'symTable')
+        mode.trace('Pushed to SymbolTable')
+        if snap :
+            mode.snapshot('called %s' % self.name)
         
         tpl = Template(mode.evalSymbols(self.body,fellow))
         rVal = tpl.safe_substitute(argBlock)
 
+        if snap :
+            mode.snapshot('returning from %s' % self.name)
         mode.popFrameFromSymbolTable()
-        mode.log('Pop From SymbolTable')
-        mode.log(mode.environment.symbolTable,'symTable')
-        mode.log('return value (rVal) is %s' % rVal)
+        mode.trace('Pop From SymbolTable')
+        mode.trace('return value (rVal) is %s', rVal)
         
         return rVal
 
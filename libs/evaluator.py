@@ -0,0 +1,219 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+An evaluator which keeps its own stack, instead of recursing through evalNode.
+"""
+
+import re
+import sys
+
+from gwNode import GWNode, MODE, LOG, FOR, MAP, CALL, TEXT
+from blocks import ArgBlock, CBlock
+from modes import BaseMode
+from profiler import outputSize
+
+
+class Return(object) :
+    """ what a generator yields last : the value of its node """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value) :
+        self.value = value
+
+
+class StackEvaluator :
+
+    def __init__(self) :
+        self.deepest = 0 # the longest the stack has been
+
+    def evaluate(self, mode, node, fellow) :
+        """ returns the same as mode.evalNode(node, fellow) would """
+        stack = [self.steps(mode, node, fellow)]
+        value = None
+        error = None
+        while True :
+            top = stack[-1]
+            try :
+                if error is None :
+                    step = top.send(value)
+                else :
+                    step = top.throw(*error)
+            except Exception :
+                # the generator didn't handle it, so pass it on to whoever asked for its value
+                error = sys.exc_info()
+                stack.pop()
+                if stack == [] :
+                    raise error[0], error[1], error[2]
+                continue
+            error = None
+
+            if step.__class__ is Return :
+                stack.pop()
+                if stack == [] :
+                    return step.value
+                value = step.value
+            else :
+                value = None
+                if step.__class__ is tuple :
+                    step = self.steps(*step)
+                stack.append(step)
+                if len(stack) > self.deepest :
+                    self.deepest = len(stack)
+
+    def steps(self, mode, node, fellow) :
+        mode.trace('evalNode %s ', node.text)
+        fellow.sideFx(node,fellow)
+        if node.__class__ != GWNode :
+            yield Return(mode.evalSymbols(node,fellow))
+            return
+
+        s = mode.nodeText(node,fellow)
+        syn = mode.syntaxOf(node,s)
+        kind = syn.kind
+
+        if kind == MODE :
+            modeName = s[2:].strip()
+            mode.trace('Mode transition to %s', modeName)
+            m = mode.environment.interpreter.modes[modeName]
+            profiler = mode.environment.interpreter.profiler
+            if profiler is not None :
+                profiler.enterFrame('mode', modeName)
+            blocks = []
+            for x in node.children :
+                blocks.append((yield (m, x, fellow)))
+            rVal = mode.sJoin(blocks)
+            if profiler is not None :
+                profiler.leaveFrame(outputSize(rVal))
+            yield Return(rVal)
+
+        elif kind == LOG :
+            mode.log(s[4:],'program')
+            blocks = []
+            for x in node.children :
+                blocks.append((yield (mode, x, fellow)))
+            yield Return(mode.sJoin(blocks))
+
+        elif kind == FOR :
+            ll = syn.lexLine(':')
+            mode.trace("In :for")
+            localName = ll.args[0]
+            argBlock = ll.args[1]
+            if argBlock[0] == '#' :
+                argBlock = argBlock[1:]
+
+            a = mode.getFromSymbolTable(argBlock)
+            profiler = mode.environment.interpreter.profiler
+            blocks = []
+            for x in a.children :
+                mode.environment.getSymbolTable().pushFrame( {localName : x} )
+                mode.trace("%s is bound to %s", localName, x)
+                if profiler is not None :
+                    profiler.enterFrame('for', localName)
+                vals = []
+                for y in node.children :
+                    vals.append((yield (mode, y, fellow)))
+                blocks.append(mode.sJoin(vals))
+                if profiler is not None :
+                    profiler.leaveFrame(outputSize(blocks[-1]))
+                mode.environment.getSymbolTable().popFrame()
+            yield Return(mode.sJoin(blocks))
+
+        elif kind == MAP :
+            blocks = []
+            blockName = s[2:].strip()
+            mode.trace('List Comprehension (applying block : %s to all items in list)', s)
+            for x in node.children :
+                args = re.split('\s',x.text)
+                blocks.append((yield self.callSteps(mode, x, blockName, fellow, args)))
+            yield Return(mode.sJoin(blocks))
+
+        elif kind == CALL :
+            mode.trace('Block call : %s', s)
+            ll = syn.lexLine(':')
+            yield Return((yield self.callSteps(mode, node, ll.key, fellow, ll.args)))
+
+        elif kind == TEXT :
+            if mode.__class__.modeEvalNode.im_func is BaseMode.modeEvalNode.im_func :
+                # the ur mode : the text followed by the children
+                t = mode.nodeText(node,fellow)
+                vals = []
+                for x in node.children :
+                    vals.append((yield (mode, x, fellow)))
+                yield Return(t + mode.sJoin(vals))
+            elif mode.compilable :
+                shape, v = mode.modeShape(node, fellow)
+                if shape is None :
+                    yield Return(v)
+                elif not shape.children :
+                    yield Return(shape.render([]))
+                else :
+                    m = shape.childMode or mode
+                    f = fellow
+                    if shape.inc :
+                        f = fellow.inc()
+                    vals = []
+                    for x in node.children :
+                        vals.append((yield (m, x, f)))
+                    yield Return(shape.render(vals))
+            else :
+                yield Return(mode.modeEvalNode(node, fellow))
+
+        else :
+            yield Return(mode.evalLine(node, s, syn, fellow))
+
+    def callSteps(self, mode, node, name, fellow, args) :
+        """ what BaseMode.callBlock, and then CBlock.call, would do """
+        c = mode.getFromSymbolTable(name)
+        blocks = ArgBlock(node,mode,fellow,mode.environment.logger)
+        mode.trace("callBlock %s (line args : %s)", name, args)
+
+        interpreter = mode.environment.interpreter
+        if c.__class__ is not CBlock or mode.jFact.im_func is not BaseMode.jFact.im_func or (
+                mode.compilable and interpreter.compileBlocks) :
+            # templates, compiled bodies and modes with their own way of joining
+            yield Return(c.call(blocks, mode, fellow))
+            return
+
+        profiler = interpreter.profiler
+        if profiler is not None :
+            profiler.enter('block', c.name)
+        memo = interpreter.blockMemo
+        key = None
+        if memo is not None :
+            key = memo.prepare(c, blocks, mode)
+            if key is not None :
+                found, rVal = memo.recall(key, c, mode)
+                if found :
+                    if profiler is not None :
+                        profiler.leave(outputSize(rVal))
+                    yield Return(rVal)
+                    return
+        symbolTable = mode.environment.symbolTable
+        depth = len(symbolTable)
+
+        snap = mode.snapshotWanted(c.name)
+        mode.pushFrameToSymbolTable(blocks)
+        mode.trace('Pushed to SymbolTable')
+        if snap :
+            mode.snapshot('called %s' % c.name)
+
+        f = fellow.inc()
+        vals = []
+        for x in c.body.children :
+            vals.append((yield (mode, x, f)))
+        rVal = '' + mode.sJoin(vals)
+
+        if snap :
+            mode.snapshot('returning from %s' % c.name)
+        mode.popFrameFromSymbolTable()
+        mode.trace('Pop From SymbolTable')
+        mode.trace('return value (rVal) is %s', rVal)
+
+        if key is not None :
+            memo.remember(key, rVal, depth, symbolTable)
+        if profiler is not None :
+            profiler.leave(outputSize(rVal))
+        yield Return(rVal)
+
@@ -12,7 +12,7 @@ def spaceUnder(s) :
     
 def fromFile(fName, log, cDir) :
     if log != None :
-        log.log("Opening file : %s" % cDir + fName)
+        log.debug("Opening file : %s%s", cDir, fName)
     f = open(cDir + fName)
     s = f.read()
     f.close()
@@ -32,10 +32,11 @@ class FellowTraveller :
     depth in the tree, the current directory etc. The FellowTraveller class holds these pieces of
     information
     """
-    def __init__(self, depth, cDir, sideFx) :
+    def __init__(self, depth, cDir, sideFx, out=None) :
         self.depth = depth
         self.cDir = cDir
         self.sideFx = sideFx
+        self.out = out # where BaseMode.writeNode writes to
 
     def inc(self) :
         """
@@ -43,11 +44,15 @@ class FellowTraveller :
         because we want to get the benefits of backing out of the recursion the right way
         This routine creates a new FellowTraveller with an incremented depth
         """
-        return FellowTraveller(self.depth+1,self.cDir,self.sideFx)
+        return FellowTraveller(self.depth+1,self.cDir,self.sideFx,self.out)
 
     def newDir(self,newDir) :
         """ Similar to FellowTraveller.inc, we want a new FellowTraveller with a new cDir"""
-        return FellowTraveller(self.depth, newDir, self.sideFx)
+        return FellowTraveller(self.depth, newDir, self.sideFx, self.out)
+
+    def withOut(self, out) :
+        """ a FellowTraveller which writes to out """
+        return FellowTraveller(self.depth, self.cDir, self.sideFx, out)
         
     def __str__(self) :
         return "&lt;&lt;%s, %s, %s&gt;&gt;" % (self.depth,self.cDir,self.sideFx)
@@ -120,4 +125,32 @@ class MultiDispatch :
             key = key + (x.__class__ ,)
         f = self.d[key]
         return f(*argList)
+
+
+class SyntaxTable :
+
+    """
+    The line syntaxes a mode understands, filed under the first character of their glyph
+    """
+
+    def __init__(self) :
+        self.byChar = {}
+
+    def add(self, glyph, pattern, handler) :
+        if pattern is not None :
+            pattern = re.compile(pattern)
+        self.byChar.setdefault(glyph[0], []).append((glyph, pattern, handler))
+
+    def lookup(self, s) :
+        """ returns (handler, match) for the first entry matching s, or (None, None) """
+        if s == '' :
+            return None, None
+        for glyph, pattern, handler in self.byChar.get(s[0], ()) :
+            if s.startswith(glyph) :
+                if pattern is None :
+                    return handler, None
+                m = pattern.match(s)
+                if m :
+                    return handler, m
+        return None, None
         
@@ -2,9 +2,11 @@
 # Copyright (c) 2007 Phil Jones <interstar@gmail.com>
 
 """ This is what GeekWeaver trees are build of"""
-from xml.dom.minidom import parse, parseString
+from xml.parsers import expat
 import re
 
+from gwHelpers import LexPageName
+
 def isStr(x) :
     return x.__class__ == str
 
@@ -21,12 +23,18 @@ def isNull(x) :
     return False
 
 
-class GWNode :
-    """This is the node that the AST of our program is made of"""
+class GWNode(object) :
+    """
+    This is the node that the AST of our program is made of.
+    Outlines can have hundreds of thousands of these, so there's no per-node __dict__
+    """
+
+    __slots__ = ('text', 'children', 'syntax')
     
     def __init__(self, text='') :
         self.text = text
         self.children = []
+        self.syntax = None # a NodeSyntax for text, filled in by nodeSyntax
 
     def addChild(self, tNode) :
         if tNode.__class__ == str :
@@ -93,23 +101,139 @@ class LexLine :
                 self.keyword(s.strip())
 
 
+
+# The kinds of line that BaseMode.evalNode tells apart, in the order it tests them
+DEFINE = 'define'      # ::name
+DATA = 'data'          # &&data
+MODE = 'mode'          # &&modeName
+LOG = 'log'            # :log
+FOR = 'for'            # :for
+MAP = 'map'            # :* blockName
+CALL = 'call'          # :blockName
+PYTHON = 'python'      # !
+COMMENT = 'comment'    # //
+TEXT = 'text'          # anything else is up to the mode
+
+def lineKind(s) :
+    if s[:2] == '::' : return DEFINE
+    if s[:6] == '&&data' : return DATA
+    if s[:2] == '&&' : return MODE
+    if s[:4] == ':log' : return LOG
+    if s[:4] == ':for' : return FOR
+    if s[:2] == ':*' : return MAP
+    if s[:1] == ':' : return CALL
+    if s[:1] == '!' : return PYTHON
+    if s[:2] == '//' : return COMMENT
+    return TEXT
+
+def isDynamic(s) :
+    """ lines which evalSymbols could change (they contain symbols, or are a #symbol lookup) """
+    return s.find('$') >= 0 or s[:1] == '#'
+
+
+class NodeSyntax(object) :
+    """
+    What we learn about a line of text just by looking at it, worked out once and kept on the node
+    """
+
+    __slots__ = ('s', 'kind', 'dynamic', 'lexed', 'pages')
+
+    def __init__(self, s) :
+        self.s = s
+        self.kind = lineKind(s)
+        self.dynamic = isDynamic(s)
+        self.lexed = None
+        self.pages = None
+
+    def lexLine(self, glyph) :
+        if self.lexed is None :
+            self.lexed = {}
+        if not glyph in self.lexed :
+            self.lexed[glyph] = LexLine(self.s, glyph)
+        return self.lexed[glyph]
+
+    def lexPageName(self, ext='html') :
+        if self.pages is None :
+            self.pages = {}
+        if not ext in self.pages :
+            self.pages[ext] = LexPageName(self.s, ext)
+        return self.pages[ext]
+
+
+def nodeSyntax(node) :
+    """ the NodeSyntax of node.text, classifying it if the text is new or has changed """
+    syn = node.syntax
+    if syn is None or syn.s is not node.text :
+        syn = node.syntax = NodeSyntax(node.text)
+    return syn
+
+def classifyTree(root) :
+    """ the pre-pass which gives every node in the tree its NodeSyntax """
+    stack = [root]
+    while stack :
+        node = stack.pop()
+        nodeSyntax(node)
+        stack.extend(node.children)
+    return root
+
     
 class OpmlToTree :
-    """Mindlessly simplistic and brittle. Uses the minidom"""
+    """
+    Builds a GWNode tree from OPML, with expat (from a string, or a file with readFile)
+    """
 
-    def __init__(self, s) :
-        self.dom = parseString(s) # makes the dom tree
+    chunkSize = 64 * 1024
+
+    def __init__(self, s=None) :
         self.root = GWNode('root')
-        tag = self.dom.getElementsByTagName('body')[0]
-        for child in tag.childNodes :
-            if child.nodeType != child.TEXT_NODE :
-                self.recurse(self.root, child)
-        
-    def recurse(self, parent, tag) :
-        node = GWNode(tag.getAttribute('text'))
-        for child in tag.childNodes :
-            if child.nodeType != child.TEXT_NODE :
-                self.recurse(node, child)
-        parent.addChild(node)
-                
+        self.stack = [] # the outlines we're currently inside
+        self.texts = {} # so that repeated lines share one string
+        self.inBody = False
+        self.seenBody = False
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        if s is not None :
+            self.parser.Parse(s, True)
+
+    def readFile(self, f, chunkSize=None) :
+        """ reads an open file in chunks of chunkSize bytes, building the tree as it goes """
+        if chunkSize is None :
+            chunkSize = self.chunkSize
+        while True :
+            data = f.read(chunkSize)
+            if not data :
+                break
+            self.parser.Parse(data, False)
+        self.parser.Parse('', True)
+        return self.root
+
+    def startElement(self, name, attrs) :
+        if self.inBody :
+            text = attrs.get('text', '')
+            self.stack.append(GWNode(self.texts.setdefault(text, text)))
+        elif name == 'body' and not self.seenBody :
+            self.inBody = True
+            self.seenBody = True
+
+    def endElement(self, name) :
+        if not self.inBody :
+            return
+        if self.stack == [] :
+            # this is the end of the body
+            self.inBody = False
+            return
+        node = self.stack.pop()
+        if self.stack :
+            self.stack[-1].addChild(node)
+        else :
+            self.root.addChild(node)
+
 
+def opmlFileToTree(fName, chunkSize=None) :
+    """ streams the OPML file fName into a GWNode tree and returns its root """
+    f = open(fName, 'rb')
+    try :
+        return OpmlToTree().readFile(f, chunkSize)
+    finally :
+        f.close()
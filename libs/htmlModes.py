@@ -1,212 +1,257 @@
 import re
 
-from modes import BaseMode
+from modes import BaseMode, Shape
 from gwNode import LexLine
+from gwHelpers import SyntaxTable
+
+WIKI_LINK = re.compile(r'(\[\[(?P<url>\S+)\s*(?P<text>\S+)\]\])')
+PERCENT_VAR = re.compile(r'\%([A-Za-z]+)')
 
 
 class HtmlMode(BaseMode) :
 
+    compilable = True
+
+    # lines which become a fixed Shape around their children
+    htmlShapes = SyntaxTable()
+    # lines which need evaluating by hand
+    htmlSyntax = SyntaxTable()
+
     def patternReplace(self,t) :
-        if re.search(r'\[\[(\S+)\s*(\S+)\]\]',t) :
-            t = re.sub(r'(\[\[(?P<url>\S+)\s*(?P<text>\S+)\]\])',"<a href='" + self.environment.siteRoot() + "\g<url>'>\g<text></a>",t)
+        if t.find('[[') >= 0 :
+            t = WIKI_LINK.sub("<a href='" + self.environment.siteRoot() + "\g<url>'>\g<text></a>",t)
         return t
 
+    def heading(self, node, t, m) :
+        return Shape('<h2>%s</h2>' % (t[1:]).strip())
+    htmlShapes.add('=', None, heading)
 
-    def modeEvalNode(self, node, fellow) :
-        b = []
-        t = self.evalSymbols(node.text,fellow)
-        joinChildren = self.jFact(fellow)
-
-        t = self.patternReplace(t)
-        
-        if len(t) > 0 :
-            
-            if t[0] == '=' :
-                b.append('<h2>%s</h2>' % (t[1:]).strip())
-                b.append( joinChildren(node))
-
-            elif re.match('\.<(.+)>',t) :
-                m = re.match('\.<(.+)>',t)        
-                b.append("""<%s>"""  % m.groups()[0] )
-                b.append( joinChildren(node))
-
-                i = m.groups()[0].find(' ')
-                if i < 0 :
-                    b.append('</%s>' % m.groups()[0] )
-                else :
-                    b.append('</%s>' % m.groups()[0][0:i] )
-
-
-            elif t[0] == '.' :
-                ll = LexLine(t,'.')
-                b.append("""<div class='%s'>%s"""  % (ll.key,' '.join(ll.args)))
-                b.append( joinChildren(node))
-                b.append('</div>')
-
-            elif t[0] == ';' :
-                ll= LexLine(t,';')
-                b.append("""<div id='%s'>%s"""  % (ll.key,' '.join(ll.args)))
-                b.append( joinChildren(node))
-                b.append('</div>')
-
-
-            elif re.match(':csv',t) :
-                
-                ll = LexLine(t,":csv")
-                fName = ll.args[0].strip()
-                if ll.args != [] :
-                    delim = ll.args[1].strip()
-                else :
-                    delim = ','                  
-                
-                self.log('opening external CSV file %s and delim is *%s* ' % (fName,delim))
-                reader = UnicodeReader(open(fName, "rb"),csv.excel,'unicode_escape',delimiter=delim.encode('utf-8'))
-                csvNode = GWNode('')
-                self.log('Got reader. Starting to iterate through it')
-                for row in reader :
-                    self.log('row : %s' % row)
-                    r = GWNode('')
-                    for c in row :
-                        self.log('adding cell %s' % c.text)
-                        r.addChild(GWNode(c))
-                    csvNode.addChild(r)
-                self.log('YYYY %s'% csvNode)
-                return csvNode
-
-            elif t[0] == '@' :
-                tpl = Template(fromFile(t[1:],self.getLog(),''))
-                blocks = self.evalArgChildren(node,joinChildren)
-                b.append(tpl.safe_substitute(blocks))
-
-            elif re.match(r'\?\s*([A-Za-z]+)\s*->\s(\S+)',t) :
-                m = re.match(r'\?\s*([A-Za-z]+)\s*->\s(\S+)',t)
-                b.append("<form name='%s' method='GET' action='%s'>" % (m.groups(0)[0],m.groups(0)[1]))
-                for child in node.children :
-                    b.append(self.getMode('htmlForm').evalNode(child, fellow))
-                b.append("\n</form>")
-
-            elif re.match(r'\?\s*([A-Za-z]+)\s*=>\s(\S+)',t) :
-                m = re.match(r'\?\s*([A-Za-z]+)\s*=>\s(\S+)',t)
-                b.append("<form name='%s' method='POST' action='%s'>" % (m.groups(0)[0],m.groups(0)[1]))
-                for child in node.children :
-                    b.append(self.getMode('htmlForm').evalNode(child, fellow))
-                b.append("\n</form>")
-
-            elif re.match(r'>\s*(.+)\s*>\s*((\S+))',t) :
-                m = re.match(r'>\s*(.+)\s*>\s*((\S+))',t)
-                b.append("<a href='%s'>%s</a>" % (m.groups(0)[1],m.groups(0)[0].strip()))
-
-            elif t[0] == ']':
-                ll = LexLine(t,']')
-                b.append("<img src='%s' alt='%s'/>" % (ll.key,' '.join(ll.args)))
-
-            elif t[0] == '*' :
-                ll = LexLine(t,'*')
-                b.append("""<ul class='%s'>""" % ll.key)
-                jc = self.jFact(fellow)
-                b.append( jc(node, '', lambda x : '\n<li>%s</li>' % x) )
-                b.append('</ul>')
-                
-            else :
-                b.append(t)
-                b.append( joinChildren(node))
+    def tag(self, node, t, m) :
+        i = m.groups()[0].find(' ')
+        if i < 0 :
+            close = '</%s>' % m.groups()[0]
         else :
-            # text value of this node is empty but children may still have value
-            b.append(t)
-            b.append( joinChildren(node))
-            
+            close = '</%s>' % m.groups()[0][0:i]
+        return Shape("""<%s>"""  % m.groups()[0], close)
+    htmlShapes.add('.', r'\.<(.+)>', tag)
+
+    def divClass(self, node, t, m) :
+        ll = self.syntaxOf(node,t).lexLine('.')
+        return Shape("""<div class='%s'>%s"""  % (ll.key,' '.join(ll.args)), '</div>')
+    htmlShapes.add('.', None, divClass)
+
+    def divId(self, node, t, m) :
+        ll = self.syntaxOf(node,t).lexLine(';')
+        return Shape("""<div id='%s'>%s"""  % (ll.key,' '.join(ll.args)), '</div>')
+    htmlShapes.add(';', None, divId)
+
+    def link(self, node, t, m) :
+        return Shape("<a href='%s'>%s</a>" % (m.groups(0)[1],m.groups(0)[0].strip()), children=False)
+    htmlShapes.add('>', r'>\s*(.+)\s*>\s*((\S+))', link)
+
+    def image(self, node, t, m) :
+        ll = self.syntaxOf(node,t).lexLine(']')
+        return Shape("<img src='%s' alt='%s'/>" % (ll.key,' '.join(ll.args)), children=False)
+    htmlShapes.add(']', None, image)
+
+    def bulletList(self, node, t, m) :
+        ll = self.syntaxOf(node,t).lexLine('*')
+        return Shape("""<ul class='%s'>""" % ll.key, '</ul>', wrap='\n<li>%s</li>')
+    htmlShapes.add('*', None, bulletList)
+
+    def csvTable(self, node, t, m, fellow) :
+        ll = self.syntaxOf(node,t).lexLine(':csv')
+        fName = ll.args[0].strip()
+        if ll.args != [] :
+            delim = ll.args[1].strip()
+        else :
+            delim = ','                  
+        
+        self.debug('opening external CSV file %s and delim is *%s* ', fName, delim)
+        self.usesFile(fName)
+        reader = UnicodeReader(open(fName, "rb"),csv.excel,'unicode_escape',delimiter=delim.encode('utf-8'))
+        csvNode = GWNode('')
+        self.debug('Got reader. Starting to iterate through it')
+        for row in reader :
+            self.trace('row : %s', row)
+            r = GWNode('')
+            for c in row :
+                self.trace('adding cell %s', c.text)
+                r.addChild(GWNode(c))
+            csvNode.addChild(r)
+        self.trace('YYYY %s', csvNode)
+        return csvNode
+    htmlSyntax.add(':csv', None, csvTable)
+
+    def fileTemplate(self, node, t, m, fellow) :
+        self.usesFile(t[1:])
+        tpl = Template(fromFile(t[1:],self.getLog(),''))
+        blocks = self.evalArgChildren(node,self.jFact(fellow))
+        return tpl.safe_substitute(blocks)
+    htmlSyntax.add('@', None, fileTemplate)
+
+    def form(self, node, m, method, fellow) :
+        b = []
+        b.append("<form name='%s' method='%s' action='%s'>" % (m.groups(0)[0],method,m.groups(0)[1]))
+        for child in node.children :
+            b.append(self.getMode('htmlForm').evalNode(child, fellow))
+        b.append("\n</form>")
         return self.sJoin(b)
 
+    def getForm(self, node, t, m, fellow) :
+        return self.form(node, m, 'GET', fellow)
+    htmlSyntax.add('?', r'\?\s*([A-Za-z]+)\s*->\s(\S+)', getForm)
+
+    def postForm(self, node, t, m, fellow) :
+        return self.form(node, m, 'POST', fellow)
+    htmlSyntax.add('?', r'\?\s*([A-Za-z]+)\s*=>\s(\S+)', postForm)
+
+    def lineShape(self, node, t) :
+        handler, m = self.htmlShapes.lookup(t)
+        if handler is None :
+            # plain text. (If it's empty, children may still have value)
+            return Shape(t)
+        return handler(self, node, t, m)
+
+    def textShape(self, node, t) :
+        if self.htmlSyntax.lookup(t)[0] is not None :
+            return None
+        return self.lineShape(node, t)
+
+    def staticShape(self, node) :
+        # [[ links depend on the siteRoot, so leave them to the interpreter
+        if node.text.find('[[') >= 0 :
+            return None
+        return self.textShape(node, node.text)
+
+    def modeShape(self, node, fellow) :
+        t = self.patternReplace(self.nodeText(node,fellow))
+        handler, m = self.htmlSyntax.lookup(t)
+        if handler is not None :
+            return None, handler(self, node, t, m, fellow)
+        return self.lineShape(node, t), None
+
+    def modeEvalNode(self, node, fellow) :
+        shape, v = self.modeShape(node, fellow)
+        if shape is None :
+            return v
+        return self.evalShape(shape, node, fellow)
+
 
     
 
 class HtmlFormMode(HtmlMode) :
 
-    def modeEvalNode(self, node, fellow) :
-        s = self.evalSymbols(node.text,fellow).strip()
-        self.log('HtmlFormMode modeEvalNode : %s' % s)
-
-        if re.match(r'\?\?',s) :
-            s = s[2:]
-            if s.find(':') > 0 :
-                parts = s.split(':')
-                return "\n%s : <input name='%s'/>"  % (parts[0],parts[1])
-            else :
-                return "\n<input name='%s'/>" % s
-        elif re.match(r'\?\*',s) :
-            b = []
-            b.append("\n<select name='%s'>" % s[2:])
-            for x in node.children :
-                parts = [y.strip() for y in self.evalSymbols(x.text,fellow).split(':')]
-                b.append("\n<option value='%s'>%s</option>" % (parts[0], parts[1]))
-            b.append("\n</select>")
-            return self.sJoin(b)
-        elif re.match(r'\?_',s):
-            s = s[2:]
-            if s.find(':') > 0 :
-                parts = s.split(':')
-                return """
+    compilable = False
+
+    formSyntax = SyntaxTable()
+
+    def textInput(self, node, s, m, fellow) :
+        s = s[2:]
+        if s.find(':') > 0 :
+            parts = s.split(':')
+            return "\n%s : <input name='%s'/>"  % (parts[0],parts[1])
+        else :
+            return "\n<input name='%s'/>" % s
+    formSyntax.add('??', None, textInput)
+
+    def select(self, node, s, m, fellow) :
+        b = []
+        b.append("\n<select name='%s'>" % s[2:])
+        for x in node.children :
+            parts = [y.strip() for y in self.evalSymbols(x.text,fellow).split(':')]
+            b.append("\n<option value='%s'>%s</option>" % (parts[0], parts[1]))
+        b.append("\n</select>")
+        return self.sJoin(b)
+    formSyntax.add('?*', None, select)
+
+    def textArea(self, node, s, m, fellow) :
+        s = s[2:]
+        if s.find(':') > 0 :
+            parts = s.split(':')
+            return """
 %s : <textarea name='%s'>
 </textarea>""" % (parts[0].strip(),parts[1].strip())
-            else :
-                return """
+        else :
+            return """
 <textarea name='%s'>
 </textarea>""" % s.strip()
-        elif re.match(r'\[\]',s) :
-            return "\n<input type='submit'/>"
-        elif re.match(r'\[\s*([A-Za-z ]+)\s*\]',s) :
-            m = re.match(r'\[\s*([A-Za-z ]+)\s*\]',s)
-            return "\n<input value='%s' type='submit'/>" % m.groups(0)
-        
-        elif re.match(r'\[\s*([A-Za-z]+)\s*;\s*([A-Za-z]+)\s*\]',s) :
-            m = re.match(r'\[\s*([A-Za-z]+)\s*;\s*([A-Za-z]+)\s*\]',s)
-            return "\n<input value='%s' name='%s' type='button'/>" % (m.groups(0)[0], m.groups(0)[1])
+    formSyntax.add('?_', None, textArea)
+
+    def submit(self, node, s, m, fellow) :
+        return "\n<input type='submit'/>"
+    formSyntax.add('[]', None, submit)
+
+    def namedSubmit(self, node, s, m, fellow) :
+        return "\n<input value='%s' type='submit'/>" % m.groups(0)
+    formSyntax.add('[', r'\[\s*([A-Za-z ]+)\s*\]', namedSubmit)
+
+    def button(self, node, s, m, fellow) :
+        return "\n<input value='%s' name='%s' type='button'/>" % (m.groups(0)[0], m.groups(0)[1])
+    formSyntax.add('[', r'\[\s*([A-Za-z]+)\s*;\s*([A-Za-z]+)\s*\]', button)
+
+    def modeEvalNode(self, node, fellow) :
+        s = self.nodeText(node,fellow).strip()
+        self.trace('HtmlFormMode modeEvalNode : %s', s)
+
+        handler, m = self.formSyntax.lookup(s)
+        if handler is not None :
+            return handler(self, node, s, m, fellow)
         
         return HtmlMode.modeEvalNode(self, node, fellow)
 
 class PhpMode(HtmlMode) :
 
-    def subPercent(self, s) :
-        r = re.compile(r'\%([A-Za-z]+)')
-        return r.sub(r'<? echo $\1 ?>',s)
-        
-    def modeEvalNode(self, node, fellow) :
-        s = self.evalSymbols(node.text,fellow).strip()
-        joinChildren = self.jFact(fellow)
-        
-        self.log('PHPMode modeEvalNode : "%s"' % s)
+    compilable = False
 
-        if s == '' : return ''
-        
-        if s[0] == '=' :
-            var = s[1:].strip()
-            return "<? $%s = $HTTP_GET_VARS['%s']; ?>" % (var,var)
-        
-        if re.match('\?:',s) :
-            # cond in PHP
-            build = []
-            if len(node.children) == 0 :
-                return ''
-            i = 1
-            build.append("""<? if %s {
+    phpSyntax = SyntaxTable()
+
+    def subPercent(self, s) :
+        return PERCENT_VAR.sub(r'<? echo $\1 ?>',s)
+
+    def getVar(self, node, s, m, fellow) :
+        var = s[1:].strip()
+        return "<? $%s = $HTTP_GET_VARS['%s']; ?>" % (var,var)
+    phpSyntax.add('=', None, getVar)
+
+    def cond(self, node, s, m, fellow) :
+        # cond in PHP
+        build = []
+        if len(node.children) == 0 :
+            return ''
+        i = 1
+        build.append("""<? if %s {
 %s
 }""" % (node.children[0].text, node.children[0].children[0].text))
-            if len(node.children) == 1 :
-                build.append(' ?>')
-                return self.sJoin(build)
-            
-            while len(node.children) - 1 > i :
-                build.append(""" elseif %s {
+        if len(node.children) == 1 :
+            build.append(' ?>')
+            return self.sJoin(build)
+        
+        while len(node.children) - 1 > i :
+            build.append(""" elseif %s {
 %s
 }""" % (node.children[i].text, self.evalNode(node.children[i].children[0], fellow)))
-                i=i+1
-            build.append(""" else {
+            i=i+1
+        build.append(""" else {
 %s
 } ?>""" % (self.evalNode(node.children[i].children[0], fellow)))
-            return self.sJoin(build)
+        return self.sJoin(build)
+    phpSyntax.add('?:', None, cond)
 
-        if re.match('"""',s) :
-            return """echo '%s';""" % joinChildren(node)
+    def echo(self, node, s, m, fellow) :
+        return """echo '%s';""" % self.jFact(fellow)(node)
+    phpSyntax.add('"""', None, echo)
+        
+    def modeEvalNode(self, node, fellow) :
+        s = self.nodeText(node,fellow).strip()
+        
+        self.trace('PHPMode modeEvalNode : "%s"', s)
+
+        if s == '' : return ''
+
+        handler, m = self.phpSyntax.lookup(s)
+        if handler is not None :
+            return handler(self, node, s, m, fellow)
         
         s = HtmlMode.modeEvalNode(self, node, fellow)
         return self.subPercent(s)
@@ -218,25 +263,17 @@ class JavascriptMode(BaseMode) :
     Right now, the Javascript mode does nothing but put some useful newlines.
     We may find decide on some other short-hands later
     """
-    def modeEvalNode(self, node,  fellow) :
-        s = self.evalSymbols(node.text,fellow)
-        joinChildren = self.jFact(fellow)
-        b = []
 
-        if len(s) > 0 :
+    compilable = True
 
-            if '{;}'.find(s[-1]) >= 0 :
-                b.append(s + '\n')
-                
-            else :
-                b.append(s)
+    def textShape(self, node, s) :
+        if len(s) > 0 and '{;}'.find(s[-1]) >= 0 :
+            return Shape(s + '\n')
+        # (if the text value of this node is empty, children may still have value)
+        return Shape(s)
 
-            b.append( joinChildren(node))
-        else :
-            # text value of this node is empty but children may still have value
-            b.append(s)
-            b.append( joinChildren(node))
-            
-        return self.sJoin(b)
+    def modeEvalNode(self, node,  fellow) :
+        s = self.nodeText(node,fellow)
+        return self.evalShape(self.textShape(node, s), node, fellow)
 
 
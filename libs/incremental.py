@@ -0,0 +1,169 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Incremental builds : re-render only the pages whose inputs have changed.
+"""
+
+import hashlib
+import json
+from os.path import exists
+
+from gwNode import GWNode, lineKind, DEFINE, PYTHON
+from blocks import CBlock, CTemplate, Thunk
+
+MANIFEST = '.gwbuild.json'
+
+
+def hashString(s) :
+    if isinstance(s, unicode) :
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
+
+
+def treeHash(node) :
+    """ a hash of the text of node and all its descendants (and the shape they make) """
+    h = hashlib.sha1()
+    todo = [node]
+    while todo :
+        n = todo.pop()
+        if n.__class__ is GWNode :
+            t = n.text
+            if isinstance(t, unicode) :
+                t = t.encode('utf-8')
+            h.update('%d:%s%d;' % (len(t), t, len(n.children)))
+            todo.extend(reversed(n.children))
+        else :
+            h.update('?%r;' % (n,))
+    return h.hexdigest()
+
+
+def hasSideEffects(node) :
+    """ does the subtree define blocks or run python """
+    todo = [node]
+    while todo :
+        n = todo.pop()
+        if n.__class__ is GWNode :
+            if n is not node and lineKind(n.text) in (DEFINE, PYTHON) :
+                return True
+            todo.extend(n.children)
+    return False
+
+
+class IncrementalBuild :
+
+    def __init__(self) :
+        self.previous = {} # page -> what it read last time, from the manifest
+        self.pages = {} # page -> what it read this time
+        self.recording = [] # the pages being rendered : [page, what it reads, reads of the page outside it]
+        self.fingerprints = {} # id(value) -> (value, fingerprint), for the blocks and trees of this build
+        self.fileFingerprints = {}
+        self.rendered = 0
+        self.skipped = 0
+
+    def load(self, dName) :
+        fName = '%s/%s' % (dName, MANIFEST)
+        if exists(fName) :
+            f = open(fName)
+            try :
+                self.previous = json.load(f).get('pages', {})
+            except ValueError :
+                self.previous = {} # a broken manifest : build everything
+            f.close()
+
+    def save(self, dName) :
+        f = open('%s/%s' % (dName, MANIFEST), 'w')
+        json.dump({'pages' : self.pages}, f, indent=1, sort_keys=True)
+        f.close()
+
+    def fingerprint(self, v) :
+        """ a string which changes when v does, or None if we can't tell """
+        if isinstance(v, basestring) :
+            return 'str:' + hashString(v)
+        if v is None or isinstance(v, (int, long, float)) :
+            return 'value:%r' % (v,)
+        known = self.fingerprints.get(id(v))
+        if known is not None and known[0] is v :
+            return known[1]
+        if v.__class__ is GWNode :
+            fp = 'tree:' + treeHash(v)
+        elif v.__class__ is CBlock :
+            if hasSideEffects(v.body) :
+                fp = None # a page which calls it is never skipped
+            else :
+                fp = 'block:' + treeHash(v.body)
+        elif v.__class__ is CTemplate :
+            if v.body.__class__ is GWNode :
+                fp = 'template:' + treeHash(v.body)
+            else :
+                fp = 'template:' + hashString(v.body)
+        else :
+            return None
+        self.fingerprints[id(v)] = (v, fp)
+        return fp
+
+    def symbolFingerprint(self, symbolTable, k) :
+        ds = symbolTable.bindings.get(k)
+        if not ds :
+            return 'missing'
+        # (without forcing an argument which hasn't been evaluated)
+        v = dict.__getitem__(ds[-1], k)
+        if v.__class__ is Thunk :
+            return None
+        return self.fingerprint(v)
+
+    def fileFingerprint(self, fName) :
+        if not fName in self.fileFingerprints :
+            if exists(fName) :
+                f = open(fName, 'rb')
+                self.fileFingerprints[fName] = 'file:' + hashString(f.read())
+                f.close()
+            else :
+                self.fileFingerprints[fName] = 'missing'
+        return self.fileFingerprints[fName]
+
+    def unchanged(self, page, node, symbolTable, context) :
+        """ can page be left as it was built last time """
+        old = self.previous.get(page)
+        if old is None or not exists(page) :
+            return False
+        if old['context'] != context or old['tree'] != treeHash(node) :
+            return False
+        for k, fp in old['symbols'].items() :
+            if fp is None or self.symbolFingerprint(symbolTable, k) != fp :
+                return False
+        for fName, fp in old['files'].items() :
+            if self.fileFingerprint(fName) != fp :
+                return False
+        self.pages[page] = old
+        self.skipped = self.skipped + 1
+        return True
+
+    def begin(self, page, node, symbolTable, context) :
+        """ start recording what page reads """
+        if hasSideEffects(node) :
+            tree = None # never skip it
+        else :
+            tree = treeHash(node)
+        entry = {'context' : context, 'tree' : tree, 'symbols' : {}, 'files' : {}}
+        self.recording.append([page, entry, symbolTable.reads])
+        symbolTable.reads = set()
+
+    def usesFile(self, fName) :
+        if self.recording :
+            self.recording[-1][1]['files'][fName] = self.fileFingerprint(fName)
+
+    def end(self, symbolTable) :
+        page, entry, outer = self.recording.pop()
+        reads = symbolTable.reads
+        for k in reads :
+            entry['symbols'][k] = self.symbolFingerprint(symbolTable, k)
+        if outer is not None :
+            outer.update(reads)
+            self.recording[-1][1]['files'].update(entry['files'])
+        symbolTable.reads = outer
+        self.pages[page] = entry
+        self.rendered = self.rendered + 1
+
+    def summary(self) :
+        return 'incremental build : %s pages rendered, %s unchanged' % (self.rendered, self.skipped)
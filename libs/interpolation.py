@@ -0,0 +1,178 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Symbol interpolation for BaseMode.evalSymbols, from pre-parsed plans.
+"""
+
+import re
+from string import Template
+
+from gwNode import isNode
+from SymbolTable import MISSING
+
+SUBSCRIPT = re.compile(r'\$(?P<name>[A-Za-z0-9_]+)\[(?P<index>[0-9\.]+)\]')
+DEFAULT = re.compile(r'\$\/(?P<name>[A-Za-z0-9_]+)\/(?P<default>\S*)\/')
+
+
+def templatePlan(s) :
+    """
+    s parsed the way Template reads it, into a tuple of literal strings and
+    (name, original text) pairs
+    """
+    parts = []
+    literal = []
+    i = 0
+    for m in Template.pattern.finditer(s) :
+        literal.append(s[i:m.start()])
+        i = m.end()
+        name = m.group('named') or m.group('braced')
+        if name is None :
+            # $$ or a $ that doesn't start a name both come out as a single $
+            literal.append(s[m.start():m.start()+1])
+            continue
+        parts.append(''.join(literal))
+        literal = []
+        parts.append((name, m.group()))
+    literal.append(s[i:])
+    parts.append(''.join(literal))
+    return tuple([p for p in parts if p != ''])
+
+def parsePlan(s) :
+    """ the plan for a string whose subscripts have already been replaced """
+    if s.find('$/') < 0 :
+        return ('template', templatePlan(s))
+    names = [m[0] for m in DEFAULT.findall(s)]
+    if names == [] :
+        return ('template', templatePlan(s))
+    found = DEFAULT.sub('$\g<name>', s)
+    notFound = DEFAULT.sub('\g<default>', s)
+    if DEFAULT.search(found) or DEFAULT.search(notFound) :
+        # the substitutions make new default refs, so later names get a say too
+        return ('defaults', names)
+    return ('default', names[0], templatePlan(found), templatePlan(notFound))
+
+
+class PlanCache :
+
+    """
+    At most size plans. When it's full, the least recently used quarter of them goes.
+    """
+
+    def __init__(self, size=4096) :
+        self.size = size
+        self.plans = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def plan(self, s) :
+        key = (s.__class__, s) # so that str and unicode results don't get mixed up
+        self.clock = self.clock + 1
+        entry = self.plans.get(key)
+        if entry is not None :
+            self.hits = self.hits + 1
+            entry[1] = self.clock
+            return entry[0]
+        self.misses = self.misses + 1
+        if len(self.plans) >= self.size :
+            self.evict()
+        p = parsePlan(s)
+        self.plans[key] = [p, self.clock]
+        return p
+
+    def evict(self) :
+        stamps = sorted([e[1] for e in self.plans.itervalues()])
+        cutoff = stamps[len(stamps) // 4]
+        for key, e in self.plans.items() :
+            if e[1] < cutoff :
+                del self.plans[key]
+
+    def clear(self) :
+        self.plans.clear()
+
+plans = PlanCache()
+
+
+def subscripts(mode, s, fellow) :
+    """ replace the $name[i] refs in s, exactly as evalSymbols always has """
+    for sym, i in SUBSCRIPT.findall(s) :
+        try :
+            a = mode.getFromSymbolTable(sym)
+            if isNode(a) :
+                if i.startswith('.') :
+                    v = a.text
+                    s = SUBSCRIPT.sub(v,s,1)
+                else :
+                    try :
+                        i = int(i)
+                        v = mode.evalNode(a.children[int(i)],fellow)
+                    except :
+                        v = "ERROR : %s is not a valid index" % i
+                s = SUBSCRIPT.sub(v,s,1)
+            else :
+                v = "ERROR : %s is not a node you can look for subscript %s of" %(a,i)
+                s = SUBSCRIPT.sub(v,s,1)
+        except Exception, e:
+            v = "ERROR : can't find symbol %s (%s)" % (sym,e)
+            s = SUBSCRIPT.sub(v,s,1)
+    return s
+
+def symbolString(mode, name, fellow) :
+    """ the symbol as a string, or None if it can't be found (or evaluated) """
+    try :
+        v = mode.lookupInSymbolTable(name, MISSING) # (which may force an argument)
+        if v is MISSING :
+            return None
+        return '%s' % (mode.valueAsString(v,fellow),)
+    except :
+        return None
+
+def runPlan(mode, parts, empty, fellow, found) :
+    """
+    fill in a template plan. empty is '' or u'', as the string was, and found
+    caches the symbols already looked up by this call
+    """
+    b = []
+    for p in parts :
+        if p.__class__ is tuple :
+            name = p[0]
+            if name not in found :
+                found[name] = symbolString(mode, name, fellow)
+            v = found[name]
+            if v is None :
+                b.append(p[1])
+            else :
+                b.append(v)
+        else :
+            b.append(p)
+    return empty.join(b)
+
+def interpolate(mode, s, fellow) :
+    if s.startswith('#') :
+        return mode.getFromSymbolTable(s[1:].strip())
+
+    if s.find('$') < 0 :
+        return s
+
+    if s.find('[') >= 0 :
+        s = subscripts(mode, s, fellow)
+
+    found = {}
+    empty = s[:0]
+    p = plans.plan(s)
+    if p[0] == 'template' :
+        return runPlan(mode, p[1], empty, fellow, found)
+
+    if p[0] == 'default' :
+        found[p[1]] = symbolString(mode, p[1], fellow)
+        if found[p[1]] is None :
+            return runPlan(mode, p[3], empty, fellow, found)
+        return runPlan(mode, p[2], empty, fellow, found)
+
+    for name in p[1] :
+        if symbolString(mode, name, fellow) is None :
+            s = DEFAULT.sub('\g<default>',s)
+        else :
+            s = DEFAULT.sub('$\g<name>',s)
+    return runPlan(mode, templatePlan(s), empty, fellow, found)
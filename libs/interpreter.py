@@ -6,12 +6,26 @@
 This is the main interpreter for GeekWeaver
 """
 
-from shutil import copytree
+import hashlib
+import json
+from shutil import copytree, rmtree, copy2
+from os import stat, remove, rename
+from os.path import isdir, exists, join, relpath
 
 from SymbolTable import *
 from modes import *
 from siteModes import PrimalMode, StaticSiteMode
 from htmlModes import HtmlMode, HtmlFormMode, PhpMode, JavascriptMode
+from treeCache import TreeCache, MemoryTreeCache
+from blockMemo import BlockMemo
+from evaluator import StackEvaluator
+from profiler import Profiler
+from incremental import IncrementalBuild
+from pagePool import PagePool
+from writer import BulkWriter
+from sync import TreeSync, MODES as SYNC_MODES
+from output import FileOutput
+from watch import makeWatcher, PreviewServer
 
 class InterpreterFactory :
     """
@@ -30,8 +44,8 @@ class InterpreterFactory :
     """
 
 
-    def __init__(self) :
-        self.logger = Logger()
+    def __init__(self, logTail=1000) :
+        self.logger = Logger(tail=logTail)
         self.symbolTable = SymbolTable()
         self.siteMapper = SiteMapper(self.logger)
         self.interpreter = Interpreter(self.symbolTable,self.siteMapper)
@@ -89,8 +103,8 @@ class Environment :
     def siteRoot(self) :
         return self.interpreter.siteRoot()
 
-    def log(self, s, typ='normal') :
-        self.logger.log(s,typ)
+    def log(self, s, typ='normal', level=None) :
+        self.logger.log(s,typ,level)
 
     def getSymbolTable(self) :
         return self.symbolTable
@@ -99,41 +113,186 @@ class Environment :
         return self.currentPageName
         
 
+OUTPUTS = '.gwoutputs.json' # what the SiteMapper wrote last time
+
 class SiteMapper :
+    """
+    Keeps the list of pages (and links) in the site, and writes the pages.
+    With keepUnchanged, files which already hold what we would write are left alone.
+    """
+
     def __init__(self,log) :
         self.log = log
         self.list = []
         self.quickList = []
+        self.keepUnchanged = False # leave files which wouldn't change as they are
+        self.prune = False # delete the pages of the last build which aren't in this one
+        self.dName = None
+        self.outputs = None # file (within dName) -> [sha1, size, mtime], from the last build
+        self.made = {} # the same, for the files written (or kept) by this build
+        self.written = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.dirs = set() # the directories we've made (or found)
+        self.writer = None # a BulkWriter, to write the pages on other threads
+        self.unstamped = [] # pages given to the writer, to add to the manifest once they're written
 
     def add(self, path, fName, shownName, body) :
         self.list.append(['page',path,fName,shownName,body])
         self.quickList.append(['page',path,fName,shownName])
 
+    def reserve(self, path, fName, shownName) :
+        """ a place in the list for a page which will be made later (see fill) """
+        self.add(path, fName, shownName, None)
+        return self.list[-1]
+
+    def fill(self, x, body, write=False) :
+        """ put the body of a page in its place, or with write, write it straight away """
+        x[4] = body
+        if write :
+            self.writePage(x)
+            x[4] = None
+
+    def openPage(self, path, fName, shownName) :
+        """ for pages that are written as they're evaluated : returns a FileOutput for the page """
+        self.add(path, fName, shownName, None)
+        self.makeDir(path)
+
+        name = '%s/%s'%(path,fName)
+        self.log.debug('process page : creating file : %s ', name)
+        if self.keepUnchanged :
+            # write it beside the old one, and see which to keep when it's finished
+            return FileOutput(name + '.new', lambda tmp : self.finishPage(name, tmp))
+        return FileOutput(name)
+
+    def finishPage(self, name, tmp) :
+        f = open(tmp, 'rb')
+        s = f.read()
+        f.close()
+        if self.sameAsFile(name, s) :
+            remove(tmp)
+            self.unchanged = self.unchanged + 1
+        else :
+            try :
+                rename(tmp, name)
+            except OSError :
+                # (Windows won't rename over a file)
+                remove(name)
+                rename(tmp, name)
+            self.written = self.written + 1
+        if self.outputs is not None :
+            self.made[self.relName(name)] = self.fileEntry(name, s)
+
 
     def addExternalLink(self,path, fName, shownName) :
         self.list.append(['link',path,fName,shownName])
         self.quickList.append(['link',path,fName,shownName])
         
 
+    def makeDir(self, path) :
+        if not path in self.dirs :
+            if not isdir(path) :
+                makedirs(path)
+            self.dirs.add(path)
+
     def writePage(self, x, subs=[]) :
-        try : makedirs(x[1])
-        except : pass
+        self.makeDir(x[1])
         
         name = '%s/%s'%(x[1],x[2])
-        self.log.log('process page : creating file : %s ' % name)
+        self.log.debug('process page : creating file : %s ', name)
         if subs != [] :
             t = Template(x[4])
             s = t.safe_substitute(subs)
         else :
             s = x[4]
-        f = open(name, 'w')
-        f.write(s)
-        f.close()
+        if isinstance(s, unicode) :
+            s = s.encode('utf-8')
+        if self.keepUnchanged and self.sameAsFile(name, s) :
+            self.log.debug('process page : %s is unchanged', name)
+            self.unchanged = self.unchanged + 1
+        elif self.writer is not None :
+            self.writer.write(name, s)
+            self.written = self.written + 1
+            if self.outputs is not None :
+                # (its mtime isn't known until it's written)
+                self.unstamped.append((name, s))
+            return
+        else :
+            f = open(name, 'w')
+            f.write(s)
+            f.close()
+            self.written = self.written + 1
+        if self.outputs is not None :
+            self.made[self.relName(name)] = self.fileEntry(name, s)
 
     def writeAll(self, subs=[]) :
         for x in self.list :
-            if x[0] == 'page' :
+            if x[0] == 'page' and x[4] is not None :
                 self.writePage(x,subs)
+        if self.writer is not None :
+            self.writer.close()
+            for name, s in self.unstamped :
+                self.made[self.relName(name)] = self.fileEntry(name, s)
+            self.unstamped = []
+
+    def relName(self, name) :
+        return relpath(name, self.dName).replace('\\','/')
+
+    def fileEntry(self, name, s) :
+        st = stat(name)
+        return [hashlib.sha1(s).hexdigest(), st.st_size, st.st_mtime]
+
+    def sameAsFile(self, name, s) :
+        """ does the file called name hold s already """
+        try :
+            st = stat(name)
+        except OSError :
+            return False
+        if st.st_size != len(s) :
+            return False
+        if self.outputs is not None :
+            old = self.outputs.get(self.relName(name))
+            if old is not None and old[1:] == [st.st_size, st.st_mtime] :
+                # not touched since we wrote it
+                return old[0] == hashlib.sha1(s).hexdigest()
+        f = open(name, 'rb')
+        same = f.read() == s
+        f.close()
+        return same
+
+    def load(self, dName) :
+        """ read the manifest that the last build left in dName """
+        self.dName = dName
+        self.outputs = {}
+        fName = join(dName, OUTPUTS)
+        if exists(fName) :
+            f = open(fName)
+            try :
+                self.outputs = json.load(f)
+            except ValueError :
+                pass
+            f.close()
+
+    def finish(self) :
+        """ prune the files the last build made and this one didn't, and write the manifest """
+        pages = set([self.relName('%s/%s' % (x[1],x[2])) for x in self.list if x[0] == 'page'])
+        for rel, entry in self.outputs.items() :
+            if rel in self.made :
+                continue
+            if rel in pages :
+                # a page which wasn't written this time (as an incremental build found it unchanged)
+                self.made[rel] = entry
+                self.unchanged = self.unchanged + 1
+            elif self.prune and exists(join(self.dName, rel)) :
+                self.log.debug('pruning %s', rel)
+                remove(join(self.dName, rel))
+                self.deleted = self.deleted + 1
+        f = open(join(self.dName, OUTPUTS), 'w')
+        json.dump(self.made, f, indent=1, sort_keys=True)
+        f.close()
+
+    def summary(self) :
+        return 'output files : %s written, %s unchanged, %s deleted' % (self.written, self.unchanged, self.deleted)
 
     def getLogger(self) :
         return self.log
@@ -171,13 +330,29 @@ class Interpreter :
         self.root = ''
         self.codedSiteRoot = '' # if script sets this, it over-rides the calculated one
         self.csvReader = None
+        self.treeCache = None # a TreeCache, if parsed OPML files should persist between runs
+        self.compileBlocks = False # compile block bodies into closures (see blockCompiler)
+        self.blockMemo = None # a BlockMemo, to remember the results of pure block calls
+        self.streamPages = False # write pages to their files as they're evaluated, not all at the end
+        self.evaluator = None # a StackEvaluator, to evaluate without recursing
+        self.profiler = None # a Profiler, to time block calls and pages
+        self.incremental = None # an IncrementalBuild, to re-render only the pages whose inputs changed
+        self.pagePool = None # a PagePool, to render pages in parallel
+        self.sync = None # a TreeSync, to copy templates and assets only where they've changed
+        self.inputs = set() # the files (and copied directories) the build has read
 
     def dumb(self, node, depth=0) :
         print "%s%s" % (('  ' * depth), node.text)
         [self.dumb(x, depth+1) for x in node.children]
 
-    def log(self,s,typ='normal') :
-        self.environment.log(s,typ)
+    def log(self,s,typ='normal',level=None) :
+        self.environment.log(s,typ,level)
+
+    def trace(self, fmt, *args) :
+        self.environment.logger.trace(fmt, *args)
+
+    def debug(self, fmt, *args) :
+        self.environment.logger.debug(fmt, *args)
 
 
     def setSymbolTable(self, symTable) :
@@ -215,10 +390,13 @@ class Interpreter :
 
 
     def opmlFileToTree(self, fName) :
-        self.log('reading, parsing and building tree %s'%fName)
-        xml = fromFile(fName, self.getLog(), '')
-        ot = OpmlToTree(xml)
-        return ot.root
+        self.debug('reading, parsing and building tree %s', fName)
+        self.inputs.add(fName)
+        if self.treeCache is not None :
+            tree = self.treeCache.opmlFileToTree(fName)
+        else :
+            tree = opmlFileToTree(fName)
+        return classifyTree(tree)
 
     
     def runFile(self, fName, dName, packages) :    
@@ -234,24 +412,34 @@ class Interpreter :
 
         self.log('make directory %s' % dName)
         self.log("<a href='%s'>%s</a>" % (dName,dName),'link')
-        mkdir(self.dName)
+        siteMapper = self.environment.siteMapper
+        if self.buildsOver() and isdir(self.dName) :
+            # building over the last build
+            if self.incremental is not None :
+                self.incremental.load(self.dName)
+        else :
+            mkdir(self.dName)
+        if siteMapper.keepUnchanged or siteMapper.prune :
+            siteMapper.load(self.dName)
 
         # TODO see if we can delete this
         #self.log('copy stdlib blocks')
         #copytree(sp + 'stdlib/blocks',self.dName + '/blocks')
 
         self.log('copy templates')
-        mkdir(self.dName + '/templates/')
-        copytree(sp + 'stdlib/templates/default',self.dName + '/templates/default')
+        if not isdir(self.dName + '/templates/') :
+            mkdir(self.dName + '/templates/')
+        self.copyTree(sp + 'stdlib/templates/default',self.dName + '/templates/default')
 
         for p in packages :
             self.log('copy template packages : %s' % p)
-            copytree(sp + 'stdlib/templates/%s'%p, self.dName + '/templates/%s'%p)
+            self.copyTree(sp + 'stdlib/templates/%s'%p, self.dName + '/templates/%s'%p)
       
         #self.log('copy dtree')
         #copytree(sp + 'standard-library/dtree',self.dName + '/dtree')
 
         self.log('loading standard template')
+        self.inputs.add(sp + 'stdlib/templates/default/template.html')
         self.indexTemplate = Template(fromFile(sp + 'stdlib/templates/default/template.html', self.getLog(),''))
 
         self.log('loading default page tree')
@@ -264,7 +452,26 @@ class Interpreter :
             self.log('Evaluating Tree')
             self.modes['primal'].evalNode(self.tree, FellowTraveller(0,self.dName,lambda x, y : x))
             self.log('Creating Files')
-            self.environment.siteMapper.writeAll()
+            if self.blockMemo is not None :
+                self.log(self.blockMemo.summary())
+            if self.environment.symbolTable.misses :
+                self.log(self.environment.symbolTable.missSummary())
+            siteMapper.writeAll()
+            if self.sync is not None :
+                self.log(self.sync.summary())
+            if siteMapper.writer is not None :
+                self.log(siteMapper.writer.summary())
+            if siteMapper.outputs is not None :
+                siteMapper.finish()
+                self.log(siteMapper.summary())
+            if self.pagePool is not None :
+                self.log(self.pagePool.summary())
+            if self.incremental is not None :
+                self.log(self.incremental.summary())
+                self.incremental.save(self.dName)
+            if self.profiler is not None :
+                self.log('Writing Profile')
+                self.profiler.write(self.dName)
             self.log('Writing Control Panel')
             self.controlPanel(self.dName)
             self.log('GeekWeaving Completed')
@@ -275,8 +482,30 @@ class Interpreter :
             self.getLog().htmlFile('log.html')
 
 
+    def buildsOver(self) :
+        """ can we build into an output directory which is already there """
+        siteMapper = self.environment.siteMapper
+        return self.incremental is not None or self.sync is not None or siteMapper.keepUnchanged or siteMapper.prune
+
+    def copyTree(self, source, dest) :
+        self.inputs.add(source)
+        if self.sync is not None :
+            self.sync.syncTree(source, dest)
+            return
+        if self.buildsOver() and isdir(dest) :
+            # (left from the last build)
+            rmtree(dest)
+        copytree(source, dest)
+
+    def copyFile(self, source, dName) :
+        self.inputs.add(source)
+        if self.sync is not None :
+            self.sync.syncFile(source, dName)
+        else :
+            copy2(source, dName)
+
     def controlPanel(self, cDir='.') :
-        self.log('writing frameset')
+        self.debug('writing frameset')
         f = open('%s/index.html' % cDir,'w')
         f.write("""
 <frameset cols="15%,85%">
@@ -284,7 +513,7 @@ class Interpreter :
    <frame name="controlmain">
 </frameset>""")
         f.close()
-        self.log('writing menu')
+        self.debug('writing menu')
         f = open('%s/menu.html' % cDir,'w')
         f.write(self.makeMenuPage())
         f.close()
@@ -302,12 +531,17 @@ class Interpreter :
     <h3>GeekWeaver</h3>
     %s
     <p>
-    <A href="../log.html" target="controlmain">Log</a>
+    <A href="../log.html" target="controlmain">Log</a>%s
     </p>
 
     </body>
 </html>        
-""" % self.siteMap
+""" % (self.siteMap, self.profileLink())
+
+    def profileLink(self) :
+        if self.profiler is None :
+            return ''
+        return '\n    <br/><A href="profile.html" target="controlmain">Profile</a>'
 
 
         
@@ -317,7 +551,7 @@ class Interpreter :
                 return makeLink(root,x0,x1,x2)
             else : return ''
     
-        self.log('in indexPage %s . index is %s' % (text,index))
+        self.trace('in indexPage %s . index is %s', text, index)
         childLinks = '\n'.join([ml(self.siteRoot(),x[0],x[1],x[2]) for x in index ])
 
         if text[0] == '&' : text = text[1:]
@@ -341,10 +575,13 @@ class Interpreter :
 
 
     def makeSiteMap(self, tree, fellow) :
-        self.log('Interpreter.makeSiteMap')
-        self.log('tree.text = %s' % tree.text)
+        self.debug('Interpreter.makeSiteMap')
+        self.debug('tree.text = %s', tree.text)
         
         self.siteMapId = 1
+        siteMap = self.rSiteMap
+        if self.evaluator is not None :
+            siteMap = self.iSiteMap
         
         self.siteMap = """
 <div class="sitemap">
@@ -354,22 +591,50 @@ Site
 </div>        
 """ % (
        '\n'.join(
-            [ self.rSiteMap(x,0,FellowTraveller(0,self.siteRoot() + ('/%s/'%spaceUnder(tree.text[1:])),lambda a,b : a)) 
+            [ siteMap(x,0,FellowTraveller(0,self.siteRoot() + ('/%s/'%spaceUnder(tree.text[1:])),lambda a,b : a)) 
                   for x in tree.children 
             ]
           )
        )
-        self.log('makeSiteMap : made siteMap : %s' % self.siteMap)
+        self.debug('makeSiteMap : made siteMap : %s', self.siteMap)
         return self.siteMap
         
     def rSiteMap(self, node, parentId, fellow) :
-        self.log('rSiteMap : %s' % node.text)
+        self.trace('rSiteMap : %s', node.text)
+        sm, subFellow = self.siteMapEntry(node, parentId, fellow)
+        if subFellow is not None :
+            thisId = self.siteMapId
+            for c in node.children :
+                sm = sm + self.rSiteMap(c, thisId, subFellow)
+        return sm
+
+    def iSiteMap(self, node, parentId, fellow) :
+        """ rSiteMap, with an explicit stack of the nodes still to visit instead of recursion """
+        build = []
+        todo = [(node, parentId, fellow)]
+        while todo != [] :
+            node, parentId, fellow = todo.pop()
+            self.trace('iSiteMap : %s', node.text)
+            sm, subFellow = self.siteMapEntry(node, parentId, fellow)
+            build.append(sm)
+            if subFellow is not None :
+                thisId = self.siteMapId
+                for c in reversed(node.children) :
+                    todo.append((c, thisId, subFellow))
+        return ''.join(build)
+
+    def siteMapEntry(self, node, parentId, fellow) :
+        """
+        The site map entry for node, and the FellowTraveller for its children if it's a
+        subdirectory (otherwise None)
+        """
         sm = ''
+        subFellow = None
         self.siteMapId = self.siteMapId + 1
         s = node.text
-        lpn = LexPageName(s)
+        lpn = nodeSyntax(node).lexPageName()
         if s == '' :
-            return ''
+            return '', None
         elif s[0] == ':' :
             pass
         elif s[0] == '@' :
@@ -394,9 +659,7 @@ Site
             <li>SUBDIR : <a href="">%s</a> (%s, %s, %s, %s)</li>
  		""" % (self.siteMapId, parentId, node.text, fellow.cDir, spaceUnder(node.text))
 
-            thisId = self.siteMapId
-            for c in node.children :
-                sm = sm + self.rSiteMap(c, thisId, fellow.newDir('%s/%s/' % (fellow.cDir, spaceUnder(s)))) 
+            subFellow = fellow.newDir('%s/%s/' % (fellow.cDir, spaceUnder(s)))
 
-        return sm
+        return sm, subFellow
 
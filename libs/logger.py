@@ -2,16 +2,174 @@
 # Copyright (c) 2007 Phil Jones <interstar@gmail.com>
 
 from os import removedirs, mkdir, rmdir, getcwd, makedirs
+from collections import deque
 import cgi
+import json
+import sys
 
-class Logger(list) :
+# log levels : messages below the Logger's level are dropped
+TRACE = 5    # every node, symbol and block call
+DEBUG = 10   # definitions, files, caches, symbol table snapshots
+INFO = 20    # the stages of a build, and :log lines
+WARN = 30
+ERROR = 40
+
+LEVELS = {'trace' : TRACE, 'debug' : DEBUG, 'info' : INFO, 'warn' : WARN, 'error' : ERROR}
+LEVEL_NAMES = dict([(v, k) for k, v in LEVELS.items()])
+
+# the level of a message logged with log(), by its type
+TYPE_LEVELS = {'error' : ERROR}
+
+def formatted(fmt, args) :
+    if args :
+        return fmt % args
+    return fmt
+
+class Snapshots :
+
+    """
+    The last size symbol table snapshots from block calls, written to fName with the log.
+    """
+
+    def __init__(self, size=100, every=1, blocks=None, fName='symtables.html') :
+        self.ring = deque(maxlen=size)
+        self.every = every
+        self.blocks = blocks # a set of block names, or None for all of them
+        self.fName = fName
+        self.calls = 0
+        self.taken = 0
+
+    def wanted(self, blockName) :
+        """ is this call to be snapshot? (asked once per call) """
+        if self.blocks is not None and not blockName in self.blocks :
+            return False
+        self.calls = self.calls + 1
+        return (self.calls - 1) % self.every == 0
+
+    def take(self, label, st) :
+        self.taken = self.taken + 1
+        self.ring.append((self.taken, label, st.html()))
+
+    def html(self) :
+        s = '<html><body><h2>The last %s of %s symbol table snapshots (from %s block calls)</h2>\n' % (
+            len(self.ring), self.taken, self.calls)
+        for n, label, table in self.ring :
+            s = s + "<h3 id='s%s'>%s : %s</h3>\n%s\n" % (n, n, cgi.escape(label), table)
+        return s + '</body></html>'
+
+def htmlEntry(x) :
+    """ a log entry ([message, type]) as html """
+    try :
+        if x[1] == 'normal' :
+            r = x[0].replace('<','&lt;')
+        elif x[1] == 'error' :
+            r = """<div style='color:red;'>%s</div>""" % x[0].replace('<','&lt;')
+        elif x[1] == 'program' :
+            r = """<div style='color:green;'>%s</div>""" % x[0].replace('<','&lt;') 
+        elif x[1] == 'html' :
+            r = """%s""" % x[0]
+        elif x[1] == 'pre' :
+            r = """
+            <pre>
+            
+            %s
+            </pre>""" % x[0]
+        else :
+            r = x[0]
+        return r
+    except :
+        print 'Error in Logger.htmlFile %s ' % x
+        assert(False)
+
+
+# Sinks : where a Logger sends each entry as it's logged
+
+class HtmlSink :
+    """ writes log.html as the build goes, flushing every entry """
+
+    def __init__(self, fName='log.html') :
+        self.fName = fName
+        self.f = open(fName, 'w')
+        self.f.write('<html><body><ul>\n')
+        self.f.flush()
+
+    def write(self, entry, level) :
+        self.f.write('<li>%s</li>\n' % htmlEntry(entry))
+        self.f.flush()
+
+    def close(self, tail='') :
+        self.f.write(tail + '</ul></body></html>')
+        self.f.close()
+
+class JsonlSink :
+    """ one JSON object per line : {"level": ..., "type": ..., "message": ...} """
+
+    def __init__(self, fName) :
+        self.fName = fName
+        self.f = open(fName, 'w')
+
+    def write(self, entry, level) :
+        self.f.write(json.dumps({'level' : LEVEL_NAMES.get(level, level), 'type' : entry[1], 'message' : entry[0]}) + '\n')
+        self.f.flush()
+
+    def close(self, tail='') :
+        self.f.close()
+
+class StderrSink :
+
+    fName = None
+
+    def __init__(self, stream=None) :
+        self.stream = stream or sys.stderr
+
+    def write(self, entry, level) :
+        self.stream.write('[%s] %s\n' % (LEVEL_NAMES.get(level, level), entry[0]))
+
+    def close(self, tail='') :
+        pass
+
+
+class Logger(deque) :
 
     """
     Manages the logs for GeekWeaver
+    Messages below the level are dropped, and only the last tail entries are kept.
     """
 
-    def __init__(self) :
-        self.index = 0
+    def __init__(self, level=INFO, tail=1000) :
+        deque.__init__(self, (), tail)
+        self.level = level
+        self.snapshots = None # a Snapshots, if symbol table snapshots are wanted
+        self.sinks = []
+        self.logged = 0 # entries kept, including those gone from the tail
+        self.written = set() # files that sinks have finished
+
+    def addSink(self, sink) :
+        self.sinks.append(sink)
+        return sink
+
+    def enabled(self, level) :
+        return level >= self.level
+
+    def trace(self, fmt, *args) :
+        if self.level <= TRACE :
+            self.log(formatted(fmt, args), 'normal', TRACE)
+
+    def debug(self, fmt, *args) :
+        if self.level <= DEBUG :
+            self.log(formatted(fmt, args), 'normal', DEBUG)
+
+    def info(self, fmt, *args) :
+        if self.level <= INFO :
+            self.log(formatted(fmt, args), 'normal', INFO)
+
+    def warn(self, fmt, *args) :
+        if self.level <= WARN :
+            self.log(formatted(fmt, args), 'normal', WARN)
+
+    def error(self, fmt, *args) :
+        if self.level <= ERROR :
+            self.log(formatted(fmt, args), 'error', ERROR)
 
     def writeFile(self,fName,s) :
         f = open(fName,'w')
@@ -19,57 +177,44 @@ class Logger(list) :
         f.close()
         
         
-    def writeSymTable(self,st) :
-        try :
-            mkdir('logs')
-        except : pass
-        fName = 'logs/log%s.html' % self.index
-        
-        self.index = self.index + 1
-        s = st.html().encode('utf-8')
-        self.writeFile(fName,s)
-        return fName                       
-        
-    def log(self, s, typ='normal') :
-        if typ == 'symTable' :
-            fName = self.writeSymTable(s)
-            self.append(["<a href='%s'>SymTable</a>"%fName,typ])
-        elif typ == 'html' or typ=='pre' :
+    def log(self, s, typ='normal', level=None) :
+        if level is None :
+            level = TYPE_LEVELS.get(typ, INFO)
+        if level < self.level :
+            return
+        if typ == 'html' or typ=='pre' :
             s = cgi.escape(s)
-            self.append([s.encode('utf-8'),typ])
+            entry = [s.encode('utf-8'),typ]
         else :
-            self.append([s.encode('utf-8'),typ])
+            entry = [s.encode('utf-8'),typ]
+        self.append(entry)
+        self.logged = self.logged + 1
+        for sink in self.sinks :
+            sink.write(entry, level)
 
     def _str_(self) :
         return '\n'.join([x[0] for x in self])
 
+    def close(self, tail='') :
+        """ finish the sinks' files """
+        for sink in self.sinks :
+            sink.close(tail)
+            self.written.add(sink.fName)
+        self.sinks = []
+
     def htmlFile(self, fName) :
-        
-        def proc(x) :
-            try :
-                if x[1] == 'normal' :
-                    r = x[0].replace('<','&lt;')
-                elif x[1] == 'error' :
-                    r = """<div style='color:red;'>%s</div>""" % x[0].replace('<','&lt;')
-                elif x[1] == 'program' :
-                    r = """<div style='color:green;'>%s</div>""" % x[0].replace('<','&lt;') 
-                elif x[1] == 'html' :
-                    r = """%s""" % x[0]
-                elif x[1] == 'pre' :
-                    r = """
-                    <pre>
-                    
-                    %s
-                    </pre>""" % x[0]
-                else :
-                    r = x[0]
-                return r
-            except :
-                print 'Error in Logger.htmlFile %s ' % x
-                assert(False)
-        
-        s = '<html><body><ul>'
-        s=s+''.join(['<li>%s</li>' % proc(x) for x in self])
-        s = s + '</ul></body></html>'
-        self.writeFile(fName,s)
-        
+        s = ''
+        if self.snapshots is not None :
+            self.writeFile(self.snapshots.fName, self.snapshots.html().encode('utf-8'))
+            s = "<li><a href='%s'>Symbol table snapshots</a></li>" % self.snapshots.fName
+        self.close(s)
+        if fName in self.written :
+            # an HtmlSink has written it already
+            return
+
+        dropped = self.logged - len(self)
+        if dropped > 0 :
+            s = '<li>(the first %s messages are not shown)</li>' % dropped + ''.join(['<li>%s</li>' % htmlEntry(x) for x in self]) + s
+        else :
+            s = ''.join(['<li>%s</li>' % htmlEntry(x) for x in self]) + s
+        self.writeFile(fName,'<html><body><ul>' + s + '</ul></body></html>')
@@ -18,6 +18,9 @@ from logger import *
 from gwHelpers import *
 
 from blocks import *
+from interpolation import interpolate
+from output import ChunkBuffer
+from profiler import outputSize
 
 try :
     from markdown import markdown 
@@ -31,6 +34,34 @@ except e :
 
 # classes        
 
+class Shape(object) :
+    """
+    Describes how a mode renders a line of plain text that has children :
+        head + sep.join([ wrap % child for each child ]) + tail
+    """
+
+    __slots__ = ('head', 'tail', 'wrap', 'sep', 'inc', 'childMode', 'post', 'children')
+
+    def __init__(self, head, tail='', wrap=None, sep='', inc=True, childMode=None, post=None, children=True) :
+        self.head = head
+        self.tail = tail
+        self.wrap = wrap
+        self.sep = sep
+        self.inc = inc
+        self.childMode = childMode
+        self.post = post
+        self.children = children
+
+    def render(self, vals) :
+        """ assembles the output from the values of the children """
+        if self.wrap is not None :
+            vals = [self.wrap % v for v in vals]
+        s = self.head + self.sep.join(vals) + self.tail
+        if self.post is not None :
+            s = self.post(s)
+        return s
+
+
 class BaseMode :
 
     """
@@ -46,17 +77,43 @@ class BaseMode :
     Instead use modeEvalNode for the stuff which is specific to your mode if you define a new one.    
     """
 
+    compilable = False
+    makesPages = False
+
     def __init__(self, environment) :
         self.environment = environment
 
-    def log(self,s, typ='normal') :
-        self.environment.interpreter.log(s,typ)
+    def log(self,s, typ='normal', level=None) :
+        self.environment.interpreter.log(s,typ,level)
+
+    def trace(self, fmt, *args) :
+        self.environment.logger.trace(fmt, *args)
+
+    def debug(self, fmt, *args) :
+        self.environment.logger.debug(fmt, *args)
+
+    def snapshotWanted(self, blockName) :
+        snapshots = self.environment.logger.snapshots
+        return snapshots is not None and snapshots.wanted(blockName)
+
+    def snapshot(self, label) :
+        self.environment.logger.snapshots.take(label, self.environment.symbolTable)
 
     def getLog(self) :
         return self.environment.logger
 
     def getFromSymbolTable(self, sym) :
         return self.environment.symbolTable.get(sym)
+
+    def lookupInSymbolTable(self, sym, default=None) :
+        return self.environment.symbolTable.lookup(sym, default)
+
+    def usesFile(self, fName) :
+        """ note that the build (and the page being made) reads fName """
+        self.environment.interpreter.inputs.add(fName)
+        incremental = self.environment.interpreter.incremental
+        if incremental is not None :
+            incremental.usesFile(fName)
     
     def pushFrameToSymbolTable(self, frame) :
         self.environment.symbolTable.pushFrame(frame)
@@ -64,6 +121,9 @@ class BaseMode :
     def popFrameFromSymbolTable(self) :
         self.environment.symbolTable.popFrame()
 
+    def defineInSymbolTable(self, sym, value) :
+        self.environment.symbolTable.define(sym, value)
+
     def getMode(self,s) :
         return self.environment.interpreter.modes[s]
 
@@ -101,121 +161,226 @@ class BaseMode :
         # put args of this call (ie. children of the tree node) into the symbolTable
         blocks = ArgBlock(node,self,fellow,self.environment.logger)
 
-        self.log("callBlock %s (line args : %s)" % (s,args))        
+        self.trace("callBlock %s (line args : %s)", s, args)        
         
         return c.call(blocks, self, fellow)
                        
 
+    def nodeText(self, node, fellow) :
+        """ the text of node with its symbols evaluated (only dynamic lines need evaluating) """
+        if nodeSyntax(node).dynamic :
+            return self.evalSymbols(node.text,fellow)
+        return node.text
+
+    def syntaxOf(self, node, s) :
+        """
+        The NodeSyntax for s, which is a line of node.
+        If s is still the node's own text, that's the one cached on the node.
+        """
+        if s is node.text :
+            return nodeSyntax(node)
+        return NodeSyntax(s)
+
     def evalNode(self, node, fellow) :
-        joinChildren = self.jFact(fellow)
-        self.log('evalNode %s ' % (node.text))
+        evaluator = self.environment.interpreter.evaluator
+        if evaluator is not None :
+            # the same thing, without recursing (see evaluator.StackEvaluator)
+            return evaluator.evaluate(self, node, fellow)
+        self.trace('evalNode %s ', node.text)
         fellow.sideFx(node,fellow)
         if node.__class__ == GWNode :
             # the node is a sub-tree
-            s = self.evalSymbols(node.text,fellow)
-          
-            # General Structural Syntax
-            
-            if re.match('::',s) :
-                # we're defining a block
-                s = s[2:]
-                self.log('defining block : %s'%s)
-                if s.find('@') >= 1 :
-                    # block from template file
-                    xs = [x.strip() for x in s.split('@')]
-                    self.log('block defined from file : %s' % xs[1])
-                    b = fromFile(xs[1], self.getLog(),'')
-                    self.pushFrameToSymbolTable({xs[0] : CTemplate(xs[0],b)})
-                elif s.find('<') >= 1 :
-                    # load a subtree from another opml file
-                    xs = [x.strip() for x in s.split('<')]
-                    self.log('block defined from subtree in file : %s' % xs[1])
-                    self.pushFrameToSymbolTable({xs[0] : CTemplate(xs[0],self.environment.interpreter.opmlFileToTree(xs[1]))})
-                    
-                else :
-                    # we're defining a subtree
-                    # put it into the table, no cute lexical closures yet
-                    self.pushFrameToSymbolTable({s.strip() : CBlock(s.strip(),node)})
-                return ''                    
-
-            if re.match('&&data',s) :
-                self.log('Mode transition to data-mode')                
-                m = self.environment.interpreter.modes['data']
-                fakester = GWNode('')
-                fakester.children = node.children
-                return fakester
-            
-            if re.match('&&',s) :
-                modeName = s[2:].strip()
-                self.log('Mode transition to %s' % modeName)
-                m = self.environment.interpreter.modes[modeName]
-                blocks = [m.evalNode(x, fellow) for x in node.children]
-                return self.sJoin(blocks)                                                   
-
-            if re.match(':log',s) :
-                self.log(s[4:],'program')
-                blocks = [self.evalNode(x, fellow) for x in node.children]
-                return self.sJoin(blocks)
-                
+            s = self.nodeText(node,fellow)
+            return self.evalLine(node, s, self.syntaxOf(node,s), fellow)
+        else :
+            # the node is actually a string so we just evaluate any symbols in it and return it
+            return self.evalSymbols(node,fellow)
 
-            if re.match(':for',s) :
-                ll = LexLine(s,':')
-                self.log("In :for")
-                localName = ll.args[0]
-                argBlock = ll.args[1]
-                if argBlock[0] == '#' : # it's just syntax to help read, more than anything else
-                    argBlock = argBlock[1:]
-            
-                a = self.getFromSymbolTable(argBlock) # the arg block
-                blocks = []
-                for x in a.children:
-                    self.environment.getSymbolTable().pushFrame( {localName : x} )
-                    self.log("%s is bound to %s" % (localName,x))
-                    blocks.append(self.sJoin( [self.evalNode(y, fellow) for y in node.children]))
-                    self.environment.getSymbolTable().popFrame()
-                    
-                return self.sJoin(blocks)
+    def evalLine(self, node, s, syn, fellow) :
+        """ evaluates node, whose text (with its symbols evaluated) is s, with syntax syn """
+        kind = syn.kind
+      
+        # General Structural Syntax
+        
+        if kind == DEFINE :
+            # we're defining a block
+            s = s[2:]
+            self.debug('defining block : %s', s)
+            if s.find('@') >= 1 :
+                # block from template file
+                xs = [x.strip() for x in s.split('@')]
+                self.debug('block defined from file : %s', xs[1])
+                self.usesFile(xs[1])
+                b = fromFile(xs[1], self.getLog(),'')
+                self.defineInSymbolTable(xs[0], CTemplate(xs[0],b))
+            elif s.find('<') >= 1 :
+                # load a subtree from another opml file
+                xs = [x.strip() for x in s.split('<')]
+                self.debug('block defined from subtree in file : %s', xs[1])
+                self.defineInSymbolTable(xs[0], CTemplate(xs[0],self.environment.interpreter.opmlFileToTree(xs[1])))
                 
+            else :
+                # we're defining a subtree
+                # put it into the innermost scope, no cute lexical closures yet
+                self.defineInSymbolTable(s.strip(), CBlock(s.strip(),node))
+            return ''                    
+
+        if kind == DATA :
+            self.trace('Mode transition to data-mode')                
+            m = self.environment.interpreter.modes['data']
+            fakester = GWNode('')
+            fakester.children = node.children
+            return fakester
+        
+        if kind == MODE :
+            modeName = s[2:].strip()
+            self.trace('Mode transition to %s', modeName)
+            m = self.environment.interpreter.modes[modeName]
+            profiler = self.environment.interpreter.profiler
+            if profiler is not None :
+                profiler.enterFrame('mode', modeName)
+            blocks = [m.evalNode(x, fellow) for x in node.children]
+            rVal = self.sJoin(blocks)
+            if profiler is not None :
+                profiler.leaveFrame(outputSize(rVal))
+            return rVal                                                   
+
+        if kind == LOG :
+            self.log(s[4:],'program')
+            blocks = [self.evalNode(x, fellow) for x in node.children]
+            return self.sJoin(blocks)
             
-            
-            if re.match(':\*',s) :
-                # call a block on each item of the sublist (kind of a comprehension)
-                blocks = []
-                blockName = s[2:].strip()
-                self.log('List Comprehension (applying block : %s to all items in list)' % s)
-                for x in node.children :
-                    args = re.split('\s',x.text)
-                    blocks.append(self.callBlock(x,blockName,fellow, args))
-                return self.sJoin(blocks)
-
-            if re.match(':',s) :
-                self.log('Block call : %s' % s)
-                ll = LexLine(s,':')
-                return self.callBlock(node,ll.key,fellow, ll.args)
-            
-            if re.match('!',s) :
-                # it's a python call (another dangerous thing)
-                return eval(s[1:])                
 
-            if re.match('//',s) :
-                # this node and sub-tree commented out
-                return ''
+        if kind == FOR :
+            ll = syn.lexLine(':')
+            self.trace("In :for")
+            localName = ll.args[0]
+            argBlock = ll.args[1]
+            if argBlock[0] == '#' : # it's just syntax to help read, more than anything else
+                argBlock = argBlock[1:]
+        
+            a = self.getFromSymbolTable(argBlock) # the arg block
+            profiler = self.environment.interpreter.profiler
+            blocks = []
+            for x in a.children:
+                self.environment.getSymbolTable().pushFrame( {localName : x} )
+                self.trace("%s is bound to %s", localName, x)
+                if profiler is not None :
+                    profiler.enterFrame('for', localName)
+                blocks.append(self.sJoin( [self.evalNode(y, fellow) for y in node.children]))
+                if profiler is not None :
+                    profiler.leaveFrame(outputSize(blocks[-1]))
+                self.environment.getSymbolTable().popFrame()
+                
+            return self.sJoin(blocks)
             
-            # If we got here then the line was neither defining a block, calling a block, nor calling a bit of python
-            return self.modeEvalNode(node, fellow)
+        
+        
+        if kind == MAP :
+            # call a block on each item of the sublist (kind of a comprehension)
+            blocks = []
+            blockName = s[2:].strip()
+            self.trace('List Comprehension (applying block : %s to all items in list)', s)
+            for x in node.children :
+                args = re.split('\s',x.text)
+                blocks.append(self.callBlock(x,blockName,fellow, args))
+            return self.sJoin(blocks)
+
+        if kind == CALL :
+            self.trace('Block call : %s', s)
+            ll = syn.lexLine(':')
+            return self.callBlock(node,ll.key,fellow, ll.args)
+        
+        if kind == PYTHON :
+            # it's a python call (another dangerous thing)
+            return eval(s[1:])                
 
+        if kind == COMMENT :
+            # this node and sub-tree commented out
+            return ''
         
-        else :
-            # the node is actually a string so we just evaluate any symbols in it and return it
-            return self.evalSymbols(node,fellow)
+        # If we got here then the line was neither defining a block, calling a block, nor calling a bit of python
+        return self.modeEvalNode(node, fellow)
 
     def modeEvalNode(self, node, fellow) :
         # this method likely to be over-ridden in the sub-classes
         # right now, because we don't have more specific information
         # we'll just create a string from the text and evaluating the children
-        s = self.evalSymbols(node.text,fellow)
+        s = self.nodeText(node,fellow)
         return  s + self.sJoin([self.evalNode(x,fellow) for x in node.children]) 
 
+    def textShape(self, node, s) :
+        """
+        The Shape in which this mode renders the plain text line s of node, or None if
+        it's a line which the mode has to handle some other way
+        """
+        return None
+
+    def modeShape(self, node, fellow) :
+        """
+        For compilable modes : (shape, None) if the plain text line node is rendered by a
+        Shape, otherwise (None, the value of node)
+        """
+        return self.textShape(node, self.nodeText(node,fellow)), None
+
+    def staticShape(self, node) :
+        """ the Shape of a node whose text has no symbols in it, if it can be worked out once and for all """
+        return self.textShape(node, node.text)
+
+    def evalShape(self, shape, node, fellow) :
+        m = shape.childMode or self
+        if not shape.children :
+            return shape.render([])
+        if shape.inc :
+            fellow = fellow.inc()
+        return shape.render([m.evalNode(x, fellow) for x in node.children])
+
+    def writeNode(self, node, fellow) :
+        """
+        Writes what evalNode would return for node into fellow.out (an output.ChunkBuffer or FileOutput)
+        """
+        if node.__class__ != GWNode or self.environment.interpreter.evaluator is not None :
+            fellow.out.write(self.evalNode(node, fellow))
+            return
+        self.trace('evalNode %s ', node.text)
+        fellow.sideFx(node,fellow)
+        s = self.nodeText(node,fellow)
+        syn = self.syntaxOf(node,s)
+        if syn.kind == TEXT and self.compilable :
+            self.modeWriteNode(node, fellow)
+        else :
+            fellow.out.write(self.evalLine(node, s, syn, fellow))
+
+    def modeWriteNode(self, node, fellow) :
+        # the streaming twin of modeEvalNode, for modes which render text with modeShape
+        shape, v = self.modeShape(node, fellow)
+        if shape is None :
+            fellow.out.write(v)
+        else :
+            self.writeShape(shape, node, fellow)
+
+    def writeShape(self, shape, node, fellow) :
+        out = fellow.out
+        if shape.post is not None or not shape.children :
+            out.write(self.evalShape(shape, node, fellow))
+            return
+        m = shape.childMode or self
+        if shape.inc :
+            fellow = fellow.inc()
+        out.write(shape.head)
+        for i in range(len(node.children)) :
+            if i > 0 and shape.sep != '' :
+                out.write(shape.sep)
+            x = node.children[i]
+            if shape.wrap is None :
+                m.writeNode(x, fellow)
+            else :
+                # wrap formats each child, so that has to be a value
+                b = ChunkBuffer()
+                m.writeNode(x, fellow.withOut(b))
+                out.write(shape.wrap % b.value())
+        out.write(shape.tail)
+
     def stringEval(self,node,environment) :
         # here we're going for a radical change :
         # only now we flatten everything to a string
@@ -223,8 +388,10 @@ class BaseMode :
         return  s + self.sJoin([self.stringEval(x,environment) for x in node.children]) 
 
     def symbolAsString(self, sym, fellow) :
-        v = self.getFromSymbolTable(sym)
+        return self.valueAsString(self.getFromSymbolTable(sym), fellow)
 
+    def valueAsString(self, v, fellow) :
+        """ the value of a symbol as evalSymbols puts it into a string """
         s = ''
         if isNode(v) :
             s = v.text
@@ -243,81 +410,25 @@ class BaseMode :
             
         
     def evalSymbols(self, s, fellow) :
-        self.log('evalSymbols with *%s*' % s)
-
-        if re.match('#',s) :
-            sym = s[1:].strip()
-            return self.getFromSymbolTable(sym)
-            
-        if s.find('$') >= 0 :
-
-            d = {} # dictionary into which we'll put all symbols
-
-            if re.search('\[',s) >= 0 :
-                # this handles vars which are actually indexes within the children,
-                # (like list index)
-                r = re.compile(r'\$(?P<name>[A-Za-z0-9_]+)\[(?P<index>[0-9\.]+)\]')
-                ds = r.findall(s)
-                for m in ds :
-                    sym = m[0]
-                    i = m[1]
-                    
-                    try :
-                        a = self.getFromSymbolTable(sym)
-                        if isNode(a) :
-                            if re.match('\.',i) :
-                                v = a.text
-                                s = r.sub(v,s,1)
-                            else :
-                                try :
-                                    i = int(i)
-                                    v = self.evalNode(a.children[int(i)],fellow)
-                                except :
-                                    v = "ERROR : %s is not a valid index" % i
-                            s = r.sub(v,s,1)
-                        else :
-                            v = "ERROR : %s is not a node you can look for subscript %s of" %(a,i)
-                            s = r.sub(v,s,1)
-                    except Exception, e:
-                        v = "ERROR : can't find symbol %s (%s)" % (sym,e)
-                        s = r.sub(v,s,1)
-                    
-            if s.find('$/') >= 0 :
-                # this handles the vars with default values
-                r = re.compile(r'\$\/(?P<name>[A-Za-z0-9_]+)\/(?P<default>\S*)\/')
-                ds = r.findall(s)
-                for m in ds :
-                    try :
-                        vm = self.symbolAsString(m[0], fellow)
-                        s = r.sub('$\g<name>',s)
-                        d[m[0]] = vm
-                    except :
-                        s = r.sub('\g<default>',s)
-                
-            r = re.compile(r'\$([A-Za-z0-9_]+)')
-            ms = r.findall(s)
-            r = re.compile(r'\$\{([A-Za-z0-9_\s]+)\}')
-            ms = ms + r.findall(s)
-            for m in ms :
-                try :
-                    d[m] = self.symbolAsString(m,fellow)
-                except : pass
-            return Template(s).safe_substitute(d)
-        else :
-            return s    
+        self.trace('evalSymbols with *%s*', s)
+        return interpolate(self, s, fellow)
 
 
 class PlainTextMode(BaseMode) :
     """
     A simple text mode. Joins every list item into CR separated lines.
     """
+    compilable = True
+
     def sJoin(self, a) :
         return '\n'.join(a)
 
+    def textShape(self, node, s) :
+        return Shape(s + "\n", sep='\n', inc=False)
+
     def modeEvalNode(self, node, fellow) :    
-        s = self.evalSymbols(node.text,fellow)
-        s = s + "\n" + self.sJoin([self.evalNode(x,fellow) for x in node.children])
-        return s
+        s = self.nodeText(node,fellow)
+        return self.evalShape(self.textShape(node, s), node, fellow)
         
 
 class DataMode(BaseMode) :
@@ -348,20 +459,26 @@ class DataMode(BaseMode) :
         return g
         
 class MarkdownMode(BaseMode) :
+
+    compilable = True
+
     def sJoin(self, a) :
         return '\n'.join(a)
 
+    def textShape(self, node, s) :
+        # the children are plain text, and the whole thing goes through markdown
+        return Shape(s + "\n", sep='\n', inc=False, childMode=self.getMode('plaintext'), post=self.runMarkdown)
+
     def modeEvalNode(self, node, fellow) :
-        s = self.evalSymbols(node.text,fellow) 
-        m = self.environment.interpreter.modes["plaintext"]        
-        blocks = [m.evalNode(x, fellow) for x in node.children]
-        s = s + "\n" + self.sJoin(blocks)
-        
-        self.log(s,'pre')
+        s = self.nodeText(node,fellow) 
+        return self.evalShape(self.textShape(node, s), node, fellow)
+
+    def runMarkdown(self, s) :
+        self.log(s,'pre',TRACE)
         if MARKDOWN_ENABLED :
             s = markdown(s)
         else :
-            self.log("Markdown was invoked, but you don't have the library installed for Python on your machine")
+            self.log("Markdown was invoked, but you don't have the library installed for Python on your machine",'normal',WARN)
             
-        self.log(s,'html')
+        self.log(s,'html',TRACE)
         return s        
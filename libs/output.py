@@ -0,0 +1,48 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Sinks that modes write their output into (fellow.out).
+"""
+
+
+class ChunkBuffer(object) :
+
+    def __init__(self) :
+        self.chunks = []
+
+    def write(self, s) :
+        self.chunks.append(s)
+
+    def getvalue(self) :
+        return ''.join(self.chunks)
+
+    def size(self) :
+        return sum([len(c) for c in self.chunks])
+
+    def value(self) :
+        """ like getvalue, but a single chunk comes back as it is (it may not be a string) """
+        if len(self.chunks) == 1 :
+            return self.chunks[0]
+        return self.getvalue()
+
+
+class FileOutput(object) :
+
+    def __init__(self, fName, onClose=None) :
+        self.fName = fName
+        self.onClose = onClose
+        self.f = open(fName, 'w')
+
+    def write(self, s) :
+        if isinstance(s, unicode) :
+            s = s.encode('utf-8')
+        self.f.write(s)
+
+    def size(self) :
+        return self.f.tell()
+
+    def close(self) :
+        self.f.close()
+        if self.onClose is not None :
+            self.onClose(self.fName)
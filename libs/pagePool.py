@@ -0,0 +1,207 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Rendering pages in parallel, in forked worker processes.
+"""
+
+from multiprocessing import Pool
+
+from gwNode import GWNode, LexLine, lineKind, DEFINE, PYTHON, CALL, MAP
+from blocks import CBlock
+from output import ChunkBuffer
+
+_pool = None # the PagePool being flushed (the workers inherit it when they're forked)
+
+
+def startWorker() :
+    # the log files are the parent's
+    _pool.logger.sinks = []
+
+def renderTask(task) :
+    return [(i, _pool.renderInWorker(i)) for i in task]
+
+
+def taskGroups(dirs, size) :
+    """ the indexes of the pages, in tasks of at most size pages from the same directory (biggest first) """
+    tasks = []
+    for i, d in enumerate(dirs) :
+        if tasks and dirs[tasks[-1][-1]] == d and len(tasks[-1]) < size :
+            tasks[-1].append(i)
+        else :
+            tasks.append([i])
+    tasks.sort(key=lambda t : -len(t))
+    return tasks
+
+
+class PageJob(object) :
+
+    __slots__ = ('mode', 'node', 'fellow', 'lpn', 'page', 'context', 'slot')
+
+    def __init__(self, mode, node, fellow, lpn, page, context, slot) :
+        self.mode = mode
+        self.node = node
+        self.fellow = fellow
+        self.lpn = lpn
+        self.page = page # the page's file
+        self.context = context # the site root, for incremental builds
+        self.slot = slot # its place in the SiteMapper
+
+
+class PagePool :
+
+    def __init__(self, workers, serial=()) :
+        self.workers = workers
+        self.serial = set(serial) # names of pages to render in order
+        self.jobs = []
+        self.pending = [] # the jobs the workers are rendering
+        self.logger = None
+        self.parallel = 0
+        self.inOrder = 0
+        self.tasks = 0
+
+    def usable(self, interpreter) :
+        return interpreter.profiler is None and interpreter.environment.logger.snapshots is None
+
+    def canDefer(self, mode, node, lpn, fName) :
+        """ can this page be rendered in a worker """
+        if fName in self.serial or lpn.pageName in self.serial :
+            return False
+        roots = list(node.children)
+        if lpn.symbol != '' :
+            roots.append(GWNode(':' + lpn.symbol))
+        return not self.hasEffects(roots, mode.environment.symbolTable)
+
+    def hasEffects(self, nodes, symbolTable) :
+        """ do these lines (or the blocks they call) define blocks or run python """
+        todo = list(nodes)
+        seen = set()
+        while todo :
+            n = todo.pop()
+            if n.__class__ is not GWNode :
+                continue
+            t = n.text
+            kind = lineKind(t)
+            if kind == DEFINE or kind == PYTHON :
+                return True
+            if kind == CALL or kind == MAP :
+                if kind == MAP :
+                    name = t[2:].strip()
+                else :
+                    name = LexLine(t, ':').key
+                ds = symbolTable.bindings.get(name)
+                if ds :
+                    b = dict.__getitem__(ds[-1], name)
+                    if b.__class__ is CBlock and not id(b) in seen :
+                        seen.add(id(b))
+                        todo.extend(b.body.children)
+            todo.extend(n.children)
+        return False
+
+    def defer(self, job) :
+        self.jobs.append(job)
+
+    def flush(self) :
+        """ render the pages waiting, and put them in their places """
+        global _pool
+        if not self.jobs :
+            return
+        jobs = self.jobs
+        self.jobs = []
+        interpreter = jobs[0].mode.environment.interpreter
+        inWorkers = self.workers > 1 and len(jobs) > 1
+        if not inWorkers :
+            results = [self.render(job) for job in jobs]
+        else :
+            interpreter.debug('page pool : rendering %s pages in %s workers', len(jobs), self.workers)
+            self.pending = jobs
+            self.logger = interpreter.environment.logger
+            _pool = self
+            tasks = taskGroups([job.fellow.cDir for job in jobs], max(1, len(jobs) // (self.workers * 4)))
+            self.tasks = self.tasks + len(tasks)
+            results = [None] * len(jobs)
+            pool = Pool(min(self.workers, len(tasks)), startWorker)
+            try :
+                for done in pool.imap_unordered(renderTask, tasks, 1) :
+                    for i, result in done :
+                        results[i] = result
+                pool.close()
+            except :
+                pool.terminate()
+                raise
+            finally :
+                pool.join()
+                _pool = None
+                self.pending = []
+            self.parallel = self.parallel + len(jobs)
+        siteMapper = interpreter.environment.siteMapper
+        incremental = interpreter.incremental
+        for job, result in zip(jobs, results) :
+            if result is None :
+                # it failed in the worker : render it here, to raise the error as the serial build would
+                body, deps = self.render(job)
+            elif inWorkers :
+                body, deps, effects = result
+                self.merge(interpreter, effects)
+                if incremental is not None :
+                    incremental.rendered = incremental.rendered + 1
+                    incremental.pages[job.page] = deps
+            else :
+                body, deps = result
+            siteMapper.fill(job.slot, body, interpreter.streamPages)
+
+    def renderInWorker(self, i) :
+        """ the page's body, what it read, and what it did to the interpreter (the files it used, the symbols
+        it didn't find, and the block memo's counts), which would otherwise be lost with the worker """
+        job = self.pending[i]
+        interpreter = job.mode.environment.interpreter
+        symbolTable = job.mode.environment.symbolTable
+        memo = interpreter.blockMemo
+        # start from nothing, so that what's there afterwards is this page's
+        interpreter.inputs = set()
+        symbolTable.misses = {}
+        if memo is not None :
+            memo.hits = memo.misses = memo.uncached = 0
+        try :
+            body, deps = self.render(job)
+        except Exception :
+            return None
+        counts = None
+        if memo is not None :
+            counts = (memo.hits, memo.misses, memo.uncached)
+        return body, deps, (interpreter.inputs, symbolTable.misses, counts)
+
+    def merge(self, interpreter, effects) :
+        """ add what a page did in a worker to the interpreter """
+        inputs, misses, counts = effects
+        interpreter.inputs.update(inputs)
+        symbolTable = interpreter.environment.symbolTable
+        for name, n in misses.items() :
+            symbolTable.misses[name] = symbolTable.misses.get(name, 0) + n
+        memo = interpreter.blockMemo
+        if memo is not None and counts is not None :
+            memo.hits = memo.hits + counts[0]
+            memo.misses = memo.misses + counts[1]
+            memo.uncached = memo.uncached + counts[2]
+
+    def render(self, job) :
+        """ the page's body, and what it read (for incremental builds) """
+        environment = job.mode.environment
+        environment.currentPageName = job.lpn.pageName
+        incremental = environment.interpreter.incremental
+        symbolTable = environment.symbolTable
+        if incremental is not None :
+            incremental.begin(job.page, job.node, symbolTable, job.context)
+        out = ChunkBuffer()
+        try :
+            job.mode.renderPage(job.node, job.lpn, job.fellow, out)
+        finally :
+            if incremental is not None :
+                incremental.end(symbolTable)
+        deps = None
+        if incremental is not None :
+            deps = incremental.pages[job.page]
+        return out.getvalue().encode('utf-8'), deps
+
+    def summary(self) :
+        return 'page pool : %s pages rendered in workers (in %s tasks), %s in order' % (self.parallel, self.tasks, self.inOrder)
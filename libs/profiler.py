@@ -0,0 +1,168 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Profiling of block calls and pages, with stacks for flame graphs.
+"""
+
+import json
+import time
+import cgi
+
+
+# how each kind of construct appears in a stack
+FRAME_PREFIXES = {'page' : '', 'block' : ':', 'mode' : '&&', 'for' : ':for '}
+
+def frameName(kind, name) :
+    # (';' separates the frames of a collapsed stack, and the weight follows the last space)
+    return (FRAME_PREFIXES.get(kind, '') + name).replace(';', ',').replace('\n', ' ')
+
+class Stat(object) :
+
+    __slots__ = ('kind', 'name', 'frame', 'calls', 'inclusive', 'selfTime', 'bytes', 'maxDepth', 'active')
+
+    def __init__(self, kind, name) :
+        self.kind = kind
+        self.name = name
+        self.frame = frameName(kind, name)
+        self.calls = 0
+        self.inclusive = 0.0
+        self.selfTime = 0.0
+        self.bytes = 0
+        self.maxDepth = 0
+        self.active = 0 # how many calls of this are open (for recursion)
+
+    def row(self) :
+        return {'kind' : self.kind, 'name' : self.name, 'calls' : self.calls,
+                'inclusive' : self.inclusive, 'self' : self.selfTime,
+                'bytes' : self.bytes, 'maxDepth' : self.maxDepth}
+
+
+def outputSize(out) :
+    if isinstance(out, basestring) :
+        return len(out)
+    return 0
+
+
+class Profiler :
+
+    def __init__(self, clock=time.time, flame=False) :
+        self.clock = clock
+        self.flame = flame # write the collapsed stacks too
+        self.stats = {} # (kind, name) -> Stat
+        # the open calls : [Stat, start, time and bytes of the calls it made, its stack, time of the Stats it called]
+        # (mode and :for frames have no Stat, and their time counts as their caller's)
+        self.stack = []
+        self.depth = 0 # how many of them have Stats
+        self.stacks = {} # collapsed stack -> [self time, self bytes]
+
+    def enter(self, kind, name) :
+        key = (kind, name)
+        stat = self.stats.get(key)
+        if stat is None :
+            stat = self.stats[key] = Stat(kind, name)
+        stat.calls = stat.calls + 1
+        stat.active = stat.active + 1
+        self.depth = self.depth + 1
+        if self.depth > stat.maxDepth :
+            stat.maxDepth = self.depth
+        self.push(stat, stat.frame)
+
+    def enterFrame(self, kind, name) :
+        """ a mode transition or :for iteration, which only shows in the collapsed stacks """
+        if self.flame :
+            self.push(None, frameName(kind, name))
+
+    def push(self, stat, frame) :
+        if self.stack :
+            path = self.stack[-1][4] + ';' + frame
+        else :
+            path = frame
+        self.stack.append([stat, self.clock(), 0.0, 0, path, 0.0])
+
+    def leave(self, size=0) :
+        stat, start, inner, innerBytes, path, statInner = self.stack.pop()
+        elapsed = self.clock() - start
+        stat.active = stat.active - 1
+        if stat.active == 0 :
+            stat.inclusive = stat.inclusive + elapsed
+        stat.selfTime = stat.selfTime + elapsed - statInner
+        stat.bytes = stat.bytes + size
+        self.depth = self.depth - 1
+        for caller in reversed(self.stack) :
+            if caller[0] is not None :
+                caller[5] = caller[5] + elapsed
+                break
+        self.weigh(path, elapsed, inner, size, innerBytes)
+
+    def leaveFrame(self, size=0) :
+        if self.flame :
+            stat, start, inner, innerBytes, path, statInner = self.stack.pop()
+            self.weigh(path, self.clock() - start, inner, size, innerBytes)
+
+    def weigh(self, path, elapsed, inner, size, innerBytes) :
+        weights = self.stacks.get(path)
+        if weights is None :
+            weights = self.stacks[path] = [0.0, 0]
+        weights[0] = weights[0] + elapsed - inner
+        weights[1] = weights[1] + size - innerBytes
+        if self.stack :
+            parent = self.stack[-1]
+            parent[2] = parent[2] + elapsed
+            parent[3] = parent[3] + size
+
+    def call(self, kind, name, f, *args) :
+        """ f(*args), profiled as name """
+        self.enter(kind, name)
+        out = None
+        try :
+            out = f(*args)
+            return out
+        finally :
+            self.leave(outputSize(out))
+
+    def rows(self) :
+        """ the stats, the most self time first """
+        return [s.row() for s in sorted(self.stats.values(), key=lambda s : (-s.selfTime, s.kind, s.name))]
+
+    def folded(self, weight='time') :
+        """ the collapsed stacks, weighted by self time (in microseconds) or by self bytes """
+        lines = []
+        for path in sorted(self.stacks.keys()) :
+            if weight == 'time' :
+                w = int(round(self.stacks[path][0] * 1000000))
+            else :
+                w = self.stacks[path][1]
+            if w > 0 :
+                # (a stack which made less than its callees, like a block whose output is dropped, has nothing to show)
+                lines.append('%s %d' % (path, w))
+        return '\n'.join(lines) + '\n'
+
+    def json(self) :
+        return json.dumps(self.rows(), indent=1)
+
+    def html(self) :
+        rows = []
+        for r in self.rows() :
+            rows.append('<tr><td>%s</td><td>%s</td><td>%s</td><td>%.4f</td><td>%.4f</td><td>%s</td><td>%s</td></tr>' % (
+                r['kind'], cgi.escape(r['name']), r['calls'], r['inclusive'], r['self'], r['bytes'], r['maxDepth']))
+        return """<html>
+<body>
+<h3>Profile</h3>
+<table border='1'>
+<tr><th>Kind</th><th>Name</th><th>Calls</th><th>Inclusive (s)</th><th>Self (s)</th><th>Bytes</th><th>Max depth</th></tr>
+%s
+</table>
+</body>
+</html>
+""" % '\n'.join(rows)
+
+    def write(self, dName) :
+        """ writes profile.json and profile.html into dName (and with flame, profile.time.folded and profile.bytes.folded) """
+        files = [('profile.json', self.json()), ('profile.html', self.html())]
+        if self.flame :
+            files = files + [('profile.time.folded', self.folded('time')), ('profile.bytes.folded', self.folded('bytes'))]
+        for fName, s in files :
+            f = open('%s/%s' % (dName, fName), 'w')
+            f.write(s.encode('utf-8'))
+            f.close()
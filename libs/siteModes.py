@@ -1,8 +1,11 @@
 import re
 
-from gwHelpers import spaceUnder, LexPageName
+from gwHelpers import spaceUnder, LexPageName, SyntaxTable
 from modes import BaseMode
+from output import ChunkBuffer
+from pagePool import PageJob
 from os import removedirs, mkdir, rmdir, getcwd, makedirs
+from os.path import isdir
 from shutil import copyfile, copytree, copy2
 
 
@@ -11,38 +14,44 @@ class PrimalMode(BaseMode) :
     """
     This is the mode that we start in, outside SiteMode
     """
+
+    makesPages = True
     
     def modeEvalNode(self, node, fellow) :
         
-        s = self.evalSymbols(node.text,fellow)  
-        self.log('evalPrimalNode %s' % s)
+        s = self.nodeText(node,fellow)  
+        self.trace('evalPrimalNode %s', s)
         if re.match('@index',s) :
             # define template file
-            self.log('evalPrimalNode\defining index template')
+            self.debug('evalPrimalNode\defining index template')
             fName = s[6:].strip()
+            self.usesFile(fName)
             self.environment.interpreter.indexTemplate = Template(fromFile(fName,self.getLog(),''))
 
         elif re.match('@fileExt',s) :
             # define default output file extension
-            self.log('evalPrimalNode\defining default file extension')
+            self.debug('evalPrimalNode\defining default file extension')
             ext = s[8:].strip()
             self.environment.interpreter.defaultFileExtension = ext
 
         elif re.match('@root',s) :
             # define default output file extension
-            self.log('evalPrimalNode\defining (coded) siteRoot')
+            self.debug('evalPrimalNode\defining (coded) siteRoot')
             r = s[5:].strip()
             self.environment.interpreter.codedSiteRoot = r
             
         elif s[0] == '&' :
             # from primal, this is starting the site
-            self.log('starting site')
-            self.log('make siteMap')
-            self.log('cDir is %s' % fellow.cDir)
-            self.log('root is %s' % self.environment.siteRoot())
+            self.debug('starting site')
+            self.debug('make siteMap')
+            self.debug('cDir is %s', fellow.cDir)
+            self.debug('root is %s', self.environment.siteRoot())
             self.environment.siteMap = self.environment.interpreter.makeSiteMap(node, fellow.cDir)
-            self.log('finish starting a site')
-            return self.getMode('staticSite').evalNode(node, (fellow.inc()).newDir(self.environment.interpreter.dName))
+            self.debug('finish starting a site')
+            site = self.getMode('staticSite')
+            rVal = site.evalNode(node, (fellow.inc()).newDir(self.environment.interpreter.dName))
+            site.flushPages()
+            return rVal
 
         return self.sJoin([self.evalNode(x,fellow.inc()) for x in node.children])
 
@@ -50,62 +59,80 @@ class PrimalMode(BaseMode) :
         
 class StaticSiteMode(BaseMode) :
 
+    makesPages = True
+
+    # what the children of a directory node can be. Anything else is a subdirectory
+    siteSyntax = SyntaxTable()
+
+    def page(self, x, m, fellow, nd, index) :
+        lpn = self.processPage(x, (fellow.inc()).newDir(nd))
+        i = [lpn.pageName,spaceUnder(lpn.outFileName),False]
+        index.append(i)
+        self.trace('index += %s', i)
+    siteSyntax.add('&', None, page)
+
+    def copyTree(self, x, m, fellow, nd, index) :
+        source = (x.text[10:]).strip()
+        #only absolute copy
+        dest = nd+"/"+(source.split("/")[-1])
+        self.debug("Want to copy directory from *%s* to *%s* ", source, dest)
+        self.environment.interpreter.copyTree(source, dest)
+    siteSyntax.add(':copytree', None, copyTree)
+
+    def copyFile(self, x, m, fellow, nd, index) :
+        source = (x.text[6:]).strip()
+        #only absolute copy
+        self.debug("Want to copy from %s to %s ", source, nd)
+        self.environment.interpreter.copyFile(source,nd)
+    siteSyntax.add(':copy', None, copyFile)
+
+    def block(self, x, m, fellow, nd, index) :
+        self.trace('eval block from StaticSiteMode')
+        self.flushPages()
+        self.evalNode(x, fellow)
+    siteSyntax.add(':', None, block)
+
+    def indexLink(self, x, m, fellow, nd, index) :
+        m = re.match('>\s*(.+)\s*>\s*(\S+)',x.text)
+        linkText = (m.groups(0)[0]).strip()
+        dest = m.groups(0)[1]
+        index.append([linkText,dest,False])
+    siteSyntax.add('>', '>\s*(.+)>\s*(\S+)', indexLink)
+
+    def flushPages(self) :
+        """ render the pages the PagePool is keeping, before anything that might change what they'd see """
+        pagePool = self.environment.interpreter.pagePool
+        if pagePool is not None :
+            pagePool.flush()
+
     def modeEvalNode(self, node, fellow) :
-        s = self.evalSymbols(node.text,fellow)  
-        self.log('evalSiteNode : %s ' % s)
+        s = self.nodeText(node,fellow)  
+        self.trace('evalSiteNode : %s ', s)
         nd = fellow.cDir
             
         if '>'.find(s[0]) > -1 :
-            self.log('evalSiteNode\doing nothing with %s' % s[0])
+            self.trace('evalSiteNode\doing nothing with %s', s[0])
 
         elif re.match('@cDir',s) :
             nd = fellow.cDir + '/' + spaceUnder(s[5:].strip())
-            self.log('evalSiteNode\changing the cDir to %s' % nd)
+            self.trace('evalSiteNode\changing the cDir to %s', nd)
         
         else :
             if s[0] == '&'  : s = s[1:]
             nd = fellow.cDir + '/' + spaceUnder(s)
-            self.log('evalSiteNode\creating directory %s (cDir %s)' % (nd, fellow.cDir))
-            makedirs(nd)
-            self.log('evalSiteNode\adding to siteMap %s ' % nd)
+            self.trace('evalSiteNode\creating directory %s (cDir %s)', nd, fellow.cDir)
+            if not isdir(nd) :
+                makedirs(nd)
+            self.trace('evalSiteNode\adding to siteMap %s ', nd)
                      
         index = []
-        self.log('evalSiteNode\starting index loop')
+        self.trace('evalSiteNode\starting index loop')
         for x in node.children :
-            self
             if x.text == '' :
-                pass
-            elif x.text[0] == '&' :
-                lpn = self.processPage(x, (fellow.inc()).newDir(nd))
-                i = [lpn.pageName,spaceUnder(lpn.outFileName),False]
-                index.append(i)
-                self.log('index += %s'%i)
-                
-                
-            elif re.match(":copytree",x.text) :
-                source = (x.text[10:]).strip()
-                #only absolute copy
-                dest = nd+"/"+(source.split("/")[-1])
-                self.log("Want to copy directory from *%s* to *%s* "%(source,dest))
-                copytree(source, dest)
-
-
-            elif re.match(":copy",x.text) :
-                source = (x.text[6:]).strip()
-                #only absolute copy
-                self.log("Want to copy from %s to %s "%(source,nd))
-                copy2(source,nd)
-
-            elif x.text[0] == ':' :
-                self.log('eval block from StaticSiteMode')
-                self.evalNode(x, fellow)
-            
-            elif re.match('>\s*(.+)>\s*(\S+)',x.text) :
-                m = re.match('>\s*(.+)\s*>\s*(\S+)',x.text)
-                linkText = (m.groups(0)[0]).strip()
-                dest = m.groups(0)[1]
-                index.append([linkText,dest,False])
-
+                continue
+            handler, m = self.siteSyntax.lookup(x.text)
+            if handler is not None :
+                handler(self, x, m, fellow, nd, index)
             else :
                 self.evalNode(x, (fellow.inc()).newDir(nd))
                 index.append([x.text,spaceUnder(x.text)+'/index.html',True])                    
@@ -116,19 +143,63 @@ class StaticSiteMode(BaseMode) :
         # now we're inside a page beause we hit a &
         fellow.sideFx(node,fellow)
         paras = []
-        text = self.evalSymbols(node.text,fellow)
-        self.log('processPage : node.text is %s ' % text)
-        lpn = LexPageName(text,self.environment.interpreter.defaultFileExtension)
+        text = self.nodeText(node,fellow)
+        self.trace('processPage : node.text is %s ', text)
+        lpn = self.syntaxOf(node,text).lexPageName(self.environment.interpreter.defaultFileExtension)
+        fName = spaceUnder(lpn.outFileName)
         
         if lpn.matches == True :
             self.environment.currentPageName = lpn.pageName
-            if lpn.symbol != '' :
-                page = self.getMode('html').callBlock(node, lpn.symbol, fellow)                             
+            page = '%s/%s' % (fellow.cDir, fName)
+            incremental = self.environment.interpreter.incremental
+            context = None
+            if incremental is not None :
+                symbolTable = self.environment.symbolTable
+                context = self.environment.siteRoot()
+                if incremental.unchanged(page, node, symbolTable, context) :
+                    self.trace('processPage : %s is unchanged', page)
+                    self.environment.siteMapper.add(fellow.cDir,fName,fName,None)
+                    return lpn
+            pagePool = self.environment.interpreter.pagePool
+            if pagePool is not None and pagePool.usable(self.environment.interpreter) :
+                if pagePool.canDefer(self, node, lpn, fName) :
+                    slot = self.environment.siteMapper.reserve(fellow.cDir,fName,fName)
+                    pagePool.defer(PageJob(self, node, fellow, lpn, page, context, slot))
+                    return lpn
+                # the pages before this one have to see the symbol table as it is now
+                pagePool.flush()
+                pagePool.inOrder = pagePool.inOrder + 1
+            if incremental is not None :
+                incremental.begin(page, node, symbolTable, context)
+            profiler = self.environment.interpreter.profiler
+            if profiler is not None :
+                profiler.enter('page', page)
+            # the page goes straight to its file, or into a buffer for the SiteMapper to write later
+            if self.environment.interpreter.streamPages :
+                out = self.environment.siteMapper.openPage(fellow.cDir,fName,fName)
             else :
-                paras = [self.getMode('html').evalNode(x, fellow) for x in node.children ]
-                page = self.sJoin(paras)
+                out = ChunkBuffer()
+            try :
+                self.renderPage(node, lpn, fellow, out)
+            finally :
+                if incremental is not None :
+                    incremental.end(symbolTable)
+                if profiler is not None :
+                    profiler.leave(out.size())
+                if self.environment.interpreter.streamPages :
+                    out.close()
        
-        self.environment.siteMapper.add(fellow.cDir,spaceUnder(lpn.outFileName),spaceUnder(lpn.outFileName),page.encode('utf-8'))
+        if not self.environment.interpreter.streamPages :
+            self.environment.siteMapper.add(fellow.cDir,fName,fName,out.getvalue().encode('utf-8'))
 
         return lpn
 
+    def renderPage(self, node, lpn, fellow, out) :
+        if lpn.symbol != '' :
+            out.write(self.getMode('html').callBlock(node, lpn.symbol, fellow))
+        else :
+            html = self.getMode('html')
+            pageFellow = fellow.withOut(out)
+            for x in node.children :
+                html.writeNode(x, pageFellow)
+
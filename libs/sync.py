@@ -0,0 +1,116 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Copying templates and assets into the site, only where they've changed.
+"""
+
+import hashlib
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
+MODES = ('copy', 'hardlink', 'symlink')
+
+
+def fileHash(fName) :
+    h = hashlib.sha1()
+    f = open(fName, 'rb')
+    while True :
+        s = f.read(65536)
+        if not s :
+            break
+        h.update(s)
+    f.close()
+    return h.hexdigest()
+
+
+class TreeSync :
+
+    def __init__(self, mode='copy', useHash=False, threads=1) :
+        if not mode in MODES :
+            raise ValueError('sync mode must be one of %s' % ', '.join(MODES))
+        self.mode = mode
+        self.useHash = useHash
+        self.threads = threads
+        self.copied = 0
+        self.linked = 0
+        self.unchanged = 0
+
+    def syncTree(self, source, dest) :
+        pairs = []
+        for dName, dirs, files in os.walk(source) :
+            rel = os.path.relpath(dName, source)
+            target = os.path.normpath(os.path.join(dest, rel))
+            if not os.path.isdir(target) :
+                os.makedirs(target)
+            for fName in files :
+                pairs.append((os.path.join(dName, fName), os.path.join(target, fName)))
+        if self.threads > 1 and len(pairs) > 1 :
+            pool = ThreadPool(self.threads)
+            try :
+                results = pool.map(self.syncPair, pairs)
+            finally :
+                pool.close()
+                pool.join()
+        else :
+            results = [self.syncPair(x) for x in pairs]
+        for r in results :
+            self.count(r)
+
+    def syncFile(self, source, dDir) :
+        """ like copy2(source, dDir) """
+        self.count(self.syncPair((source, os.path.join(dDir, os.path.basename(source)))))
+
+    def count(self, result) :
+        if result == 'copied' :
+            self.copied = self.copied + 1
+        elif result == 'linked' :
+            self.linked = self.linked + 1
+        else :
+            self.unchanged = self.unchanged + 1
+
+    def syncPair(self, pair) :
+        source, dest = pair
+        if self.mode == 'symlink' :
+            target = os.path.abspath(source)
+            if os.path.islink(dest) and os.readlink(dest) == target :
+                return 'unchanged'
+            self.clear(dest)
+            os.symlink(target, dest)
+            return 'linked'
+
+        if self.mode == 'hardlink' :
+            if os.path.exists(dest) and not os.path.islink(dest) and os.path.samefile(source, dest) :
+                return 'unchanged'
+            self.clear(dest)
+            try :
+                os.link(source, dest)
+                return 'linked'
+            except OSError :
+                # (another filesystem, or one without links)
+                shutil.copy2(source, dest)
+                return 'copied'
+
+        if os.path.islink(dest) or (os.path.exists(dest) and os.path.samefile(source, dest)) :
+            # a link from another mode : make it a copy
+            self.clear(dest)
+        elif os.path.exists(dest) :
+            s = os.stat(source)
+            d = os.stat(dest)
+            if s.st_size == d.st_size :
+                # (copy2 keeps the mtime to the microsecond)
+                if abs(s.st_mtime - d.st_mtime) < 0.000002 :
+                    return 'unchanged'
+                if self.useHash and fileHash(source) == fileHash(dest) :
+                    shutil.copystat(source, dest)
+                    return 'unchanged'
+        shutil.copy2(source, dest)
+        return 'copied'
+
+    def clear(self, dest) :
+        if os.path.islink(dest) or os.path.exists(dest) :
+            os.remove(dest)
+
+    def summary(self) :
+        return 'sync (%s) : %s copied, %s linked, %s unchanged' % (self.mode, self.copied, self.linked, self.unchanged)
@@ -0,0 +1,158 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+A persistent cache of parsed OPML files.
+"""
+
+import marshal
+import hashlib
+from os import stat, rename, makedirs
+from os.path import abspath, join, isdir
+
+from gwNode import GWNode, opmlFileToTree
+
+CACHE_FORMAT = 1
+
+
+def treeToArrays(root) :
+    texts = []
+    counts = []
+    stack = [root]
+    while stack :
+        node = stack.pop()
+        texts.append(node.text)
+        counts.append(len(node.children))
+        stack.extend(reversed(node.children))
+    return texts, counts
+
+def arraysToTree(texts, counts) :
+    shared = {} # so that repeated lines share one string
+    root = GWNode(texts[0])
+    stack = [[root, counts[0]]] # nodes still waiting for children, and how many
+    for i in xrange(1, len(texts)) :
+        while stack[-1][1] == 0 :
+            stack.pop()
+        top = stack[-1]
+        text = shared.setdefault(texts[i], texts[i])
+        node = GWNode(text)
+        top[0].children.append(node)
+        top[1] = top[1] - 1
+        if counts[i] :
+            stack.append([node, counts[i]])
+    return root
+
+def hashFile(fName, chunkSize=64 * 1024) :
+    h = hashlib.sha1()
+    f = open(fName, 'rb')
+    try :
+        while True :
+            data = f.read(chunkSize)
+            if not data :
+                break
+            h.update(data)
+    finally :
+        f.close()
+    return h.hexdigest()
+
+
+class TreeCache :
+
+    def __init__(self, cacheDir, log=None) :
+        self.cacheDir = cacheDir
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        if not isdir(cacheDir) :
+            makedirs(cacheDir)
+
+    def entryName(self, fName) :
+        return join(self.cacheDir, hashlib.sha1(abspath(fName)).hexdigest() + '.gwt')
+
+    def readEntry(self, fName) :
+        try :
+            f = open(self.entryName(fName), 'rb')
+        except IOError :
+            return None
+        try :
+            try :
+                entry = marshal.load(f)
+            except (EOFError, ValueError, TypeError) :
+                return None
+        finally :
+            f.close()
+        if entry[0] != CACHE_FORMAT :
+            return None
+        return entry
+
+    def writeEntry(self, fName, size, mtime, contentHash, texts, counts) :
+        name = self.entryName(fName)
+        f = open(name + '.tmp', 'wb')
+        marshal.dump((CACHE_FORMAT, abspath(fName), size, mtime, contentHash, texts, counts), f)
+        f.close()
+        rename(name + '.tmp', name)
+
+    def opmlFileToTree(self, fName) :
+        """ returns the tree for fName, from the cache if the file hasn't changed """
+        st = stat(fName)
+        entry = self.readEntry(fName)
+        if entry is not None and entry[2] == st.st_size and entry[3] == st.st_mtime :
+            return self.hit(fName, entry[5], entry[6])
+
+        contentHash = hashFile(fName)
+        if entry is not None and entry[4] == contentHash :
+            # touched but not changed, so just remember the new mtime
+            self.writeEntry(fName, st.st_size, st.st_mtime, contentHash, entry[5], entry[6])
+            return self.hit(fName, entry[5], entry[6])
+
+        self.misses = self.misses + 1
+        if self.log != None :
+            self.log.debug('tree cache miss : parsing %s', fName)
+        tree = opmlFileToTree(fName)
+        texts, counts = treeToArrays(tree)
+        self.writeEntry(fName, st.st_size, st.st_mtime, contentHash, texts, counts)
+        return tree
+
+    def hit(self, fName, texts, counts) :
+        self.hits = self.hits + 1
+        if self.log != None :
+            self.log.debug('tree cache hit : %s', fName)
+        return arraysToTree(texts, counts)
+
+
+class MemoryTreeCache :
+
+    """
+    Keeps the flattened trees in memory, for gw.py --watch, checking each file's content
+    """
+
+    def __init__(self, under=None, log=None) :
+        self.under = under
+        self.log = log
+        self.entries = {} # absolute path -> (content hash, texts, counts)
+        self.hits = 0
+        self.misses = 0
+
+    def opmlFileToTree(self, fName) :
+        # (an edit saved quickly may leave the size and mtime as they were)
+        key = abspath(fName)
+        contentHash = hashFile(fName)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == contentHash :
+            self.hits = self.hits + 1
+            if self.log != None :
+                self.log.debug('tree cache hit (in memory) : %s', fName)
+            return arraysToTree(entry[1], entry[2])
+
+        self.misses = self.misses + 1
+        if self.under is not None and entry is None :
+            tree = self.under.opmlFileToTree(fName)
+        else :
+            # changed since we read it, so the TreeCache may not have noticed either
+            tree = opmlFileToTree(fName)
+        texts, counts = treeToArrays(tree)
+        self.entries[key] = (contentHash, texts, counts)
+        return tree
+
+    def summary(self) :
+        return 'tree cache (in memory) : %s hits, %s misses' % (self.hits, self.misses)
@@ -0,0 +1,204 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Watching the files a build read, and serving the site while it's worked on.
+"""
+
+import os
+import select
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+def expand(paths) :
+    """ the files to watch, and the directories (with all their subdirectories) """
+    files = set()
+    trees = set()
+    for p in paths :
+        p = os.path.abspath(p)
+        if os.path.isdir(p) :
+            trees.add(p)
+        else :
+            files.add(p)
+    return files, trees
+
+
+def inTree(path, trees) :
+    for t in trees :
+        if path == t or path.startswith(t + os.sep) :
+            return True
+    return False
+
+
+class PollingWatcher :
+
+    def __init__(self, interval=0.5, settle=0.2) :
+        self.interval = interval
+        self.settle = settle
+        self.state = {}
+
+    def watch(self, paths) :
+        self.files, self.trees = expand(paths)
+        self.state = self.look()
+
+    def look(self) :
+        state = {}
+        names = list(self.files)
+        for t in self.trees :
+            for dName, dirs, files in os.walk(t) :
+                names.extend([os.path.join(dName, x) for x in files])
+        for name in names :
+            try :
+                st = os.stat(name)
+                state[name] = (st.st_size, st.st_mtime)
+            except OSError :
+                state[name] = None
+        return state
+
+    def changes(self) :
+        state = self.look()
+        changed = [k for k in set(state) | set(self.state) if state.get(k) != self.state.get(k)]
+        self.state = state
+        return changed
+
+    def wait(self) :
+        """ block until something changes, and return what did """
+        while True :
+            time.sleep(self.interval)
+            changed = self.changes()
+            if changed :
+                while True :
+                    time.sleep(self.settle)
+                    more = self.changes()
+                    if not more :
+                        return sorted(changed)
+                    changed.extend(more)
+
+    def close(self) :
+        pass
+
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_CLOEXEC = 0x80000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher :
+
+    def __init__(self, settle=0.2) :
+        self.settle = settle
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.init = libc.inotify_init1 # (an AttributeError where there's no inotify)
+        self.addWatch = libc.inotify_add_watch
+        self.addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = None
+        self.dirs = {}
+
+    def watch(self, paths) :
+        self.close()
+        self.fd = self.init(IN_CLOEXEC)
+        if self.fd < 0 :
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.files, self.trees = expand(paths)
+        dirs = set([os.path.dirname(f) for f in self.files])
+        for t in self.trees :
+            for dName, subdirs, files in os.walk(t) :
+                dirs.add(dName)
+        self.dirs = {}
+        for d in dirs :
+            if os.path.isdir(d) :
+                wd = self.addWatch(self.fd, d, WATCH_MASK)
+                if wd >= 0 :
+                    self.dirs[wd] = d
+
+    def events(self, timeout) :
+        """ the paths we care about which have changed, waiting at most timeout seconds for any """
+        ready, w, x = select.select([self.fd], [], [], timeout)
+        if not ready :
+            return None
+        data = os.read(self.fd, 65536)
+        changed = []
+        i = 0
+        while i + EVENT.size <= len(data) :
+            wd, mask, cookie, size = EVENT.unpack_from(data, i)
+            name = data[i + EVENT.size : i + EVENT.size + size].rstrip('\0')
+            i = i + EVENT.size + size
+            if mask & IN_Q_OVERFLOW :
+                changed.append('(too many changes)')
+                continue
+            d = self.dirs.get(wd)
+            if d is None :
+                continue
+            path = os.path.join(d, name)
+            if path in self.files or inTree(path, self.trees) :
+                changed.append(path)
+        return changed
+
+    def wait(self) :
+        """ block until something changes, and return what did """
+        changed = []
+        while not changed :
+            changed = self.events(None)
+        while True :
+            more = self.events(self.settle)
+            if more is None :
+                return sorted(set(changed))
+            changed.extend(more)
+
+    def close(self) :
+        if self.fd is not None :
+            os.close(self.fd)
+            self.fd = None
+
+
+def makeWatcher(poll=False) :
+    if not poll :
+        try :
+            return InotifyWatcher()
+        except (OSError, AttributeError) :
+            pass
+    return PollingWatcher()
+
+
+class PreviewHandler(SimpleHTTPRequestHandler) :
+
+    def translate_path(self, path) :
+        # SimpleHTTPRequestHandler serves the current directory
+        rel = os.path.relpath(SimpleHTTPRequestHandler.translate_path(self, path), os.getcwd())
+        return os.path.join(self.server.dName, rel)
+
+    def log_message(self, format, *args) :
+        pass
+
+
+class PreviewServer(ThreadingMixIn, HTTPServer) :
+
+    daemon_threads = True
+
+    def __init__(self, dName, port, host='127.0.0.1') :
+        self.dName = os.path.abspath(dName)
+        HTTPServer.__init__(self, (host, port), PreviewHandler)
+
+    def url(self) :
+        return 'http://%s:%s/' % self.server_address
+
+    def start(self) :
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
@@ -0,0 +1,111 @@
+# Released under the GNU General Public License, v3.0 or later
+# Copyright (c) 2007 Phil Jones <interstar@gmail.com>
+
+"""
+Writing the site's files on a pool of threads.
+"""
+
+import os
+import threading
+import time
+import Queue
+
+
+class BulkWriter :
+
+    def __init__(self, threads=4, queueSize=64, batchBytes=65536, fsync=False, clock=time.time) :
+        self.threads = threads
+        self.batchBytes = batchBytes
+        self.fsync = fsync
+        self.clock = clock
+        self.queue = Queue.Queue(queueSize)
+        self.batch = []
+        self.batchSize = 0
+        self.workers = []
+        self.error = None
+        self.files = 0
+        self.bytes = 0
+        self.puts = 0
+        self.depths = 0 # the queue depths seen by each put, added up
+        self.maxDepth = 0
+        self.started = None
+        self.seconds = 0.0
+
+    def start(self) :
+        self.started = self.clock()
+        for i in range(self.threads) :
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def write(self, name, s) :
+        if not self.workers :
+            self.start()
+        self.files = self.files + 1
+        self.bytes = self.bytes + len(s)
+        if len(s) >= self.batchBytes :
+            self.put([(name, s)])
+            return
+        self.batch.append((name, s))
+        self.batchSize = self.batchSize + len(s)
+        if self.batchSize >= self.batchBytes :
+            self.flush()
+
+    def flush(self) :
+        if self.batch :
+            self.put(self.batch)
+            self.batch = []
+            self.batchSize = 0
+
+    def put(self, item) :
+        depth = self.queue.qsize()
+        self.puts = self.puts + 1
+        self.depths = self.depths + depth
+        if depth > self.maxDepth :
+            self.maxDepth = depth
+        self.queue.put(item)
+
+    def run(self) :
+        while True :
+            item = self.queue.get()
+            if item is None :
+                return
+            if self.error is not None :
+                continue # (drain the queue, so close doesn't wait forever)
+            try :
+                for name, s in item :
+                    f = open(name, 'w')
+                    f.write(s)
+                    if self.fsync :
+                        f.flush()
+                        os.fsync(f.fileno())
+                    f.close()
+            except Exception, e :
+                self.error = e
+
+    def close(self) :
+        """ wait until everything is written """
+        if not self.workers :
+            return
+        self.flush()
+        for t in self.workers :
+            self.queue.put(None)
+        for t in self.workers :
+            t.join()
+        self.workers = []
+        self.seconds = self.seconds + self.clock() - self.started
+        if self.error is not None :
+            error = self.error
+            self.error = None
+            raise error
+
+    def summary(self) :
+        rate = 0.0
+        if self.seconds > 0 :
+            rate = self.bytes / self.seconds / 1048576
+        mean = 0.0
+        if self.puts :
+            mean = float(self.depths) / self.puts
+        return 'writer : %s files, %.2f MB in %.2f s (%.2f MB/s), queue depth %.1f mean, %s max' % (
+            self.files, self.bytes / 1048576.0, self.seconds, rate, mean, self.maxDepth)
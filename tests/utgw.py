@@ -4,8 +4,16 @@ import string
 
 import libs.gwNode
 from libs.SymbolTable import *
-import libs.gwModes 
 from libs.interpreter import * 
+from libs.treeCache import *
+from libs.blockCompiler import *
+from libs.interpolation import *
+from libs.blockMemo import *
+from libs.output import *
+from libs.pagePool import *
+from libs.writer import *
+from libs.sync import *
+from libs.watch import *
 
 class TestMiscTools(unittest.TestCase) :
 
@@ -20,6 +28,102 @@ class TestMiscTools(unittest.TestCase) :
         self.assertEquals(md.call("f",("aa","bb")),"aabb")
         self.assertEquals(md.call("f",("aa",4)),"aa : (4)")
 
+    def testSyntaxTable(self) :
+        st = SyntaxTable()
+        st.add(':copytree', None, 'tree')
+        st.add(':copy', None, 'copy')
+        st.add(':', None, 'block')
+        st.add('>', r'>\s*(.+)>\s*(\S+)', 'link')
+        self.assertEquals(st.lookup(':copytree a'),('tree',None))
+        self.assertEquals(st.lookup(':copy a')[0],'copy')
+        self.assertEquals(st.lookup(':x')[0],'block')
+        h, m = st.lookup('> home > index.html')
+        self.assertEquals(h,'link')
+        self.assertEquals(m.groups()[1],'index.html')
+        self.assertEquals(st.lookup('> nowhere'),(None,None))
+        self.assertEquals(st.lookup('plain text'),(None,None))
+        self.assertEquals(st.lookup(''),(None,None))
+
+    def testLogLevels(self) :
+        class Counted :
+            formatted = 0
+            def __str__(self) :
+                Counted.formatted = Counted.formatted + 1
+                return 'counted'
+
+        log = Logger()
+        self.assertEquals(log.level,INFO)
+        log.trace('node %s', Counted())
+        log.debug('node %s', Counted())
+        log.log('a stage')
+        log.log('from the outline','program')
+        self.assertEquals(Counted.formatted,0)
+        self.assertEquals([x for x in log],[['a stage','normal'],['from the outline','program']])
+
+        log = Logger(WARN)
+        log.log('a stage')
+        log.warn('careful %s', 'now')
+        log.error('broken %s %s', 'x', 1)
+        self.assertEquals([x for x in log],[['careful now','normal'],['broken x 1','error']])
+
+        log = Logger(LEVELS['trace'])
+        log.trace('node %s', Counted())
+        log.log('a stage')
+        self.assertEquals(Counted.formatted,1)
+        self.assertEquals([x[0] for x in log],['node counted','a stage'])
+        self.assertFalse(Logger(ERROR).enabled(INFO))
+
+    def testLogSinks(self) :
+        import tempfile, os, json, StringIO
+        d = tempfile.mkdtemp()
+        err = StringIO.StringIO()
+        log = Logger(INFO, tail=3)
+        log.addSink(HtmlSink(os.path.join(d,'log.html')))
+        log.addSink(JsonlSink(os.path.join(d,'log.jsonl')))
+        log.addSink(StderrSink(err))
+        for x in range(5) :
+            log.info('message %s', x)
+        log.error('broken')
+        self.assertEquals([x[0] for x in log],['message 3','message 4','broken'])
+        self.assertTrue('message 0' in open(os.path.join(d,'log.html')).read())
+
+        log.htmlFile(os.path.join(d,'log.html'))
+        s = open(os.path.join(d,'log.html')).read()
+        self.assertTrue('<li>message 0</li>' in s and s.endswith('</ul></body></html>'))
+        lines = [json.loads(x) for x in open(os.path.join(d,'log.jsonl'))]
+        self.assertEquals(lines[-1],{'level' : 'error', 'type' : 'error', 'message' : 'broken'})
+        self.assertEquals(len(lines),6)
+        self.assertEquals(err.getvalue().splitlines()[0],'[info] message 0')
+
+        # without a sink, log.html shows the tail
+        log.htmlFile(os.path.join(d,'tail.html'))
+        s = open(os.path.join(d,'tail.html')).read()
+        self.assertTrue('the first 3 messages are not shown' in s and not 'message 0' in s)
+        import shutil
+        shutil.rmtree(d)
+
+    def testSnapshots(self) :
+        def run(snapshots) :
+            i = Interpreter(SymbolTable(),SiteMapper(Logger()))
+            i.getLog().snapshots = snapshots
+            t = GWNode('')
+            t.addChild(GWNode('::a').addChild('$x'))
+            t.addChild(GWNode('::b').addChild('b'))
+            for x in range(6) :
+                t.addChild(GWNode(':a').addChild(GWNode('x : %s' % x)))
+                t.addChild(GWNode(':b'))
+            i.evalNode(t)
+            return snapshots
+
+        s = run(Snapshots(size=4))
+        self.assertEquals((s.calls,s.taken,len(s.ring)),(12,24,4))
+        self.assertEquals([x[1] for x in s.ring],['called a','returning from a','called b','returning from b'])
+
+        s = run(Snapshots(size=100, every=2, blocks=set(['a'])))
+        self.assertEquals((s.calls,s.taken),(6,6))
+        self.assertTrue("<td>x</td><td>4</td>" in s.ring[-1][2])
+        self.assertTrue('returning from a' in s.html())
+
     
 class TestSymbolTable(unittest.TestCase) :
     
@@ -50,6 +154,59 @@ class TestSymbolTable(unittest.TestCase) :
             self.assertEquals(st.get('x'),'%s'%y)
             st.popFrame()
 
+    def testLookup(self) :
+        st = SymbolTable()
+        st.pushFrame({'a' : None, 'b' : 2})
+        self.assertEquals(st.lookup('b'),2)
+        self.assertEquals(st.lookup('a',MISSING),None)
+        self.assertTrue(st.lookup('c',MISSING) is MISSING)
+        self.assertEquals(st.lookup('c','?'),'?')
+        self.assertTrue(st.has('a'))
+        self.assertFalse(st.has('c'))
+        self.assertRaises(SymbolTableException,st.get,'d')
+        self.assertEquals(st.misses,{'c' : 3, 'd' : 1})
+        self.assertEquals(st.missSummary(),'symbols not found : c (3), d (1)')
+
+        # optional references are settled without any exceptions
+        i = Interpreter(SymbolTable(),SiteMapper(Logger()))
+        m = i.modes["ur"]
+        self.assertEquals(m.evalSymbols("$/title/untitled/ $x",nullFellowTraveller()),"untitled $x")
+        self.assertEquals(i.getSymbolTable().misses,{'title' : 1, 'x' : 1})
+
+    def testScopes(self) :
+        st = SymbolTable()
+        st.pushFrame({'a' : 1, 'b' : 2})
+        st.define('blk', 'outer')
+        st.pushFrame({'a' : 3})
+        st.define('blk', 'inner')
+        st.define('a', 4)
+        self.assertEquals(st.depth(),3)
+        self.assertEquals((st.get('a'),st.get('b'),st.get('blk')),(4,2,'inner'))
+
+        above = st.setAside(2)
+        self.assertEquals((st.get('a'),st.get('blk')),(1,'outer'))
+        st.restore(above)
+        self.assertEquals((st.get('a'),st.get('blk')),(4,'inner'))
+        self.assertTrue('inner' in st.html())
+
+        st.popFrame()
+        self.assertEquals((st.get('a'),st.get('blk')),(1,'outer'))
+        st.popFrame()
+        self.assertRaises(SymbolTableException,st.get,'blk')
+
+        # definitions don't add frames, and those made in a block body go when it returns
+        i = Interpreter(SymbolTable(),SiteMapper(Logger()))
+        depth = len(i.getSymbolTable())
+        t = GWNode('')
+        for x in range(50) :
+            t.addChild(GWNode('::b%s' % x).addChild('%s' % x))
+        t.addChild(GWNode('::local').addChild(GWNode('::helper').addChild('h')).addChild(GWNode(':helper')))
+        t.addChild(GWNode(':b49'))
+        t.addChild(GWNode(':local'))
+        self.assertEquals(i.evalNode(t),'49h')
+        self.assertEquals(len(i.getSymbolTable()),depth)
+        self.assertRaises(SymbolTableException,i.getSymbolTable().get,'helper')
+
 
 class testLexers(unittest.TestCase) :
 
@@ -116,6 +273,30 @@ class testLexers(unittest.TestCase) :
         self.assertEquals(lpn.outFileName,'main.svg')
         self.assertEquals(lpn.symbol,'svgDiag')
 
+    def testNodeSyntax(self) :
+        kinds = [('::block',DEFINE),('&&data',DATA),('&&html',MODE),(':log hi',LOG),
+                 (':for x,, #d',FOR),(':* rep',MAP),(':block a,, b',CALL),('! 1+1',PYTHON),
+                 ('// off',COMMENT),('.myClass',TEXT),('',TEXT)]
+        for s,k in kinds :
+            self.assertEquals(NodeSyntax(s).kind,k)
+
+        t = GWNode(':block a,, b')
+        classifyTree(GWNode('root').addChild(t))
+        syn = t.syntax
+        self.assertEquals(syn.kind,CALL)
+        self.assertFalse(syn.dynamic)
+        self.assertTrue(nodeSyntax(t) is syn)
+        self.assertEquals(syn.lexLine(':').key,'block')
+        self.assertTrue(syn.lexLine(':') is syn.lexLine(':'))
+        self.assertEquals(NodeSyntax('&main :page').lexPageName().symbol,'page')
+
+        # changing the text means classifying again
+        t.text = '// gone'
+        self.assertEquals(nodeSyntax(t).kind,COMMENT)
+
+        self.assertTrue(NodeSyntax(':$name').dynamic)
+        self.assertTrue(NodeSyntax('#data').dynamic)
+
 
 class TestGWNode(unittest.TestCase) :
 
@@ -153,8 +334,88 @@ class TestGWNode(unittest.TestCase) :
         self.assertFalse(isStr(tn))
         self.assertTrue(isStr(ts))
 
+    def testOpmlToTree(self) :
+        from StringIO import StringIO
+        opml = """<?xml version="1.0"?>
+<opml version="2.0">
+<head><title>test</title></head>
+<body>
+  <outline text="&amp;page">
+    <outline text=".&lt;p&gt;"><outline text="hello"/></outline>
+    <outline text="world"/>
+  </outline>
+  <outline created="no text attribute"/>
+</body>
+</opml>"""
+        for root in [OpmlToTree(opml).root, OpmlToTree().readFile(StringIO(opml),7)] :
+            self.assertEquals(root.text,'root')
+            self.assertEquals(len(root.children),2)
+            page = root.children[0]
+            self.assertEquals(page.text,'&page')
+            self.assertEquals([x.text for x in page.children],['.<p>','world'])
+            self.assertEquals(page.children[0].children[0].text,'hello')
+            self.assertEquals(root.children[1].text,'')
+            self.assertEquals(root.size(root),6)
+
+    def testCompactNodes(self) :
+        self.assertFalse(hasattr(GWNode('x'),'__dict__'))
+        root = OpmlToTree('<opml><body><outline text="same"/><outline text="same"/></body></opml>').root
+        self.assertTrue(root.children[0].text is root.children[1].text)
+
                           
 
+class TestTreeCache(unittest.TestCase) :
+
+    def testArrays(self) :
+        t = GWNode('root').addChild(GWNode('a').addChild('b').addChild('c')).addChild('d')
+        texts, counts = treeToArrays(t)
+        self.assertEquals(texts,['root','a','b','c','d'])
+        self.assertEquals(counts,[2,2,0,0,0])
+        t2 = arraysToTree(texts, counts)
+        self.assertEquals(treeToArrays(t2),(texts,counts))
+
+    def testCache(self) :
+        import tempfile, shutil, os
+        d = tempfile.mkdtemp()
+        try :
+            src = os.path.join(d,'src.opml')
+            def writeSrc(text, mtime) :
+                f = open(src,'w')
+                f.write('<opml><body><outline text="%s"/></body></opml>' % text)
+                f.close()
+                os.utime(src,(mtime,mtime))
+
+            writeSrc('hello',1000)
+            tc = TreeCache(os.path.join(d,'cache'))
+            self.assertEquals(tc.opmlFileToTree(src).children[0].text,'hello')
+            self.assertEquals((tc.hits,tc.misses),(0,1))
+            self.assertEquals(tc.opmlFileToTree(src).children[0].text,'hello')
+            self.assertEquals((tc.hits,tc.misses),(1,1))
+
+            # touched, but the same content
+            writeSrc('hello',2000)
+            self.assertEquals(tc.opmlFileToTree(src).children[0].text,'hello')
+            self.assertEquals((tc.hits,tc.misses),(2,1))
+
+            writeSrc('world',3000)
+            self.assertEquals(tc.opmlFileToTree(src).children[0].text,'world')
+            self.assertEquals((tc.hits,tc.misses),(2,2))
+
+            mc = MemoryTreeCache()
+            self.assertEquals(mc.opmlFileToTree(src).children[0].text,'world')
+            self.assertEquals(mc.opmlFileToTree(src).children[0].text,'world')
+            self.assertEquals((mc.hits,mc.misses),(1,1))
+            writeSrc('again',4000)
+            self.assertEquals(mc.opmlFileToTree(src).children[0].text,'again')
+            self.assertEquals((mc.hits,mc.misses),(1,2))
+            # the same size and mtime, but not the same text
+            writeSrc('agian',4000)
+            self.assertEquals(mc.opmlFileToTree(src).children[0].text,'agian')
+            self.assertEquals((mc.hits,mc.misses),(1,3))
+        finally :
+            shutil.rmtree(d)
+
+
 class TestArgBlock(unittest.TestCase) :
 
     def buildInterpreter(self) :
@@ -212,6 +473,22 @@ class TestArgBlock(unittest.TestCase) :
         self.assertEquals(ab['__'].__class__,GWNode)
         self.assertEquals(ab['_'].children[0].text,'a')
         self.assertEquals(ab['__'].children[0].text,'these')
+
+    def testLazyArgs(self) :
+        i = self.buildInterpreter()
+        t = GWNode('')
+        t.addChild(GWNode('::inner').addChild('$v $_0'))
+        t.addChild(GWNode('::outer').addChild(GWNode(':inner B').addChild(GWNode('v : $_0')).addChild(GWNode('boom : ').addChild('!1/0'))))
+        t.addChild(GWNode(':outer A'))
+        # v is evaluated where the call was made, and boom is never evaluated at all
+        self.assertEquals(i.evalNode(t),'A B')
+
+        t = GWNode(':f').addChild(GWNode('x : ').addChild('!1/0')).addChild('anon')
+        ab = i.modes['ur'].makeArgBlock(t)
+        self.assertEquals(dict.__getitem__(ab,'x').__class__,Thunk)
+        self.assertEquals(ab['__0'],'anon')
+        self.assertEquals(dict.__getitem__(ab,'__0'),'anon')
+        self.assertRaises(ZeroDivisionError,lambda : ab['x'])
         
         
 
@@ -272,6 +549,26 @@ class TestEvalSymbol(unittest.TestCase) :
 
         self.assertEquals(m.evalSymbols('#zewp',nullFellowTraveller()),t)
 
+    def testInterpolationPlans(self) :
+        i = self.buildInterpreter()
+        i.getSymbolTable().pushFrame({"x" : "world", "n" : 3})
+        m = i.modes["ur"]
+        f = nullFellowTraveller()
+        self.assertEquals(templatePlan('a $x ${y} $$ $9'),('a ',('x','$x'),' ',('y','${y}'),' $ $9'))
+        self.assertEquals(m.evalSymbols("$x ${x} $nope $$x $n",f),"world world $nope $x 3")
+        # the first default ref decides for all of them
+        self.assertEquals(m.evalSymbols("$/y/a/ $/x/b/",f),"a b")
+        self.assertEquals(m.evalSymbols("$/x/a/ $/y/b/",f),"world $y")
+        self.assertEquals(m.evalSymbols("$x[0]",f),"ERROR : world is not a node you can look for subscript 0 of")
+        self.assertEquals(m.evalSymbols(u"$x",f).__class__,unicode)
+
+        pc = PlanCache(8)
+        for k in range(20) :
+            pc.plan('$x %s' % k)
+        pc.plan('$x 19')
+        self.assert_(len(pc.plans) <= 8)
+        self.assertEquals((pc.hits,pc.misses),(1,20))
+
         
     
 class TestModes(unittest.TestCase) :
@@ -280,6 +577,33 @@ class TestModes(unittest.TestCase) :
         i = Interpreter(SymbolTable(),SiteMapper(Logger()))
         return i
 
+    def interpreters(self) :
+        """ an interpreter with each evaluator : the recursive one, and a StackEvaluator """
+        for evaluator in [None, StackEvaluator()] :
+            i = self.buildInterpreter()
+            i.evaluator = evaluator
+            yield i
+
+    def tickClock(self) :
+        """ a clock which goes on a tick each time it's read """
+        ticks = [0]
+        def clock() :
+            ticks[0] = ticks[0] + 1
+            return ticks[0]
+        return clock
+
+    def assertSameOutput(self, tree, configure=None, render=None) :
+        """ tree() comes out the same from a plain interpreter and one set up by configure (or rendered by render) """
+        expected = self.buildInterpreter().evalNode(tree())
+        i = self.buildInterpreter()
+        if configure is not None :
+            configure(i)
+        if render is not None :
+            self.assertEquals(render(i, tree()),expected)
+        else :
+            self.assertEquals(i.evalNode(tree()),expected)
+        return i
+
 
     def testBasicEval(self) :
         i = self.buildInterpreter()
@@ -759,6 +1083,271 @@ echo 'more';
 
         
 
+    def testCompiledBlocks(self) :
+        def site() :
+            t = GWNode('')
+            b = GWNode('::blk')
+            b.addChild(GWNode('.<div class="x">').addChild(GWNode('=Title')).addChild(GWNode('*list').addChild('a').addChild('b')))
+            b.addChild(GWNode('hello $who // not a comment'))
+            b.addChild(GWNode('// commented').addChild('out'))
+            b.addChild(GWNode('.c').addChild(GWNode('$who')))
+            b.addChild(GWNode('&&javascript').addChild(GWNode('f(x) {').addChild(' return x;').addChild('}')))
+            b.addChild(GWNode('&&plaintext').addChild(GWNode('line').addChild('one').addChild('$who')))
+            b.addChild(GWNode('> Link > http://www.nooranch.com'))
+            b.addChild(GWNode(':inner'))
+            t.addChild(GWNode('::inner').addChild(GWNode('.<b>').addChild('inside')))
+            t.addChild(b)
+            t.addChild(GWNode(':blk').addChild(GWNode('who : world')))
+            t.addChild(GWNode(':blk').addChild(GWNode('who : there')))
+            return t
+
+        def compiled(i) :
+            i.compileBlocks = True
+        self.assertSameOutput(site, compiled)
+
+    def testConstantFolding(self) :
+        i = self.buildInterpreter()
+        body = GWNode('::b').addChild(GWNode('.<p>').addChild('plain').addChild(GWNode('// gone'))).addChild(GWNode('$x'))
+        c = BlockCompiler(i.modes['html'])
+        self.assertTrue(isConstant(c.compileNode(body.children[0])))
+        self.assertEquals(c.compileNode(body.children[0]).value,'<p>plain</p>')
+        self.assertFalse(isConstant(c.compileNode(body.children[1])))
+
+    def testWriteNode(self) :
+        def page() :
+            t = GWNode('')
+            t.addChild(GWNode('::blk').addChild(GWNode('.<b>').addChild('$who')))
+            t.addChild(GWNode('.<div class="x">').addChild(GWNode('=Title')).addChild(GWNode('*list').addChild('a').addChild(GWNode('.<i>').addChild('b'))))
+            t.addChild(GWNode('.c').addChild(GWNode(':blk').addChild(GWNode('who : world'))))
+            t.addChild(GWNode('&&plaintext').addChild(GWNode('line').addChild('one').addChild('two')))
+            t.addChild(GWNode('> Link > http://www.nooranch.com'))
+            t.addChild(GWNode('// gone').addChild('really'))
+            return t
+
+        out = ChunkBuffer()
+        f = nullFellowTraveller().withOut(out)
+        def write(i, node) :
+            i.modes['html'].writeNode(node, f)
+            return out.getvalue()
+        i = self.assertSameOutput(page, render=write)
+        self.assertTrue(len(out.chunks) > 10)
+        self.assertEquals(f.inc().newDir('x').out,out)
+
+        # data still comes back as nodes
+        d = i.evalNode(GWNode('&&data').addChild('a').addChild('b'))
+        self.assertEquals(d.__class__,GWNode)
+        self.assertEquals([x.text for x in d.children],['a','b'])
+
+    def testBlockMemo(self) :
+        def site() :
+            t = GWNode('')
+            t.addChild(GWNode('::head').addChild(GWNode('.<h1>').addChild('$title')).addChild(GWNode(':for x ,, #__').addChild('$x')))
+            t.addChild(GWNode('::free').addChild('$title $elsewhere'))
+            t.addChild(GWNode('::outer').addChild(GWNode(':head').addChild('title : in')))
+            for title in ['a','b','a','a'] :
+                t.addChild(GWNode(':head').addChild(GWNode('title : %s' % title)).addChild('one'))
+            t.addChild(GWNode(':free').addChild(GWNode('title : a')))
+            t.addChild(GWNode(':free').addChild(GWNode('title : a')))
+            t.addChild(GWNode(':outer'))
+            # an argument which evaluates to a number
+            t.addChild(GWNode(':head').addChild('!1+1'))
+            return t
+
+        def memo(i) :
+            i.blockMemo = BlockMemo()
+        i = self.assertSameOutput(site, memo)
+        # head is called 4 times from the top and once by outer, free uses a symbol that isn't an arg,
+        # outer calls a block, and the last head's argument isn't a string
+        self.assertEquals((i.blockMemo.hits,i.blockMemo.misses,i.blockMemo.uncached),(2,3,4))
+        self.assertTrue('2' in i.evalNode(GWNode(':head').addChild('!1+1')))
+
+        p = Purity().analyseTree(site().children[0])
+        self.assertTrue(p.pure)
+        self.assertEquals(p.names(),('__','title'))
+        self.assertFalse(Purity().analyseTree(GWNode('').addChild('!1+1')).pure)
+        self.assertEquals(canonical(GWNode('a').addChild('b')),('node','a',(('node','b',()),)))
+        self.assertEquals(canonical(GWNode('$a')),None)
+
+    def testProfiler(self) :
+        def site() :
+            t = GWNode('')
+            t.addChild(GWNode('::inner').addChild('$x'))
+            t.addChild(GWNode('::outer').addChild(GWNode(':inner').addChild(GWNode('x : abc'))).addChild('end'))
+            t.addChild(GWNode(':outer'))
+            t.addChild(GWNode(':outer'))
+            t.addChild(GWNode(':inner').addChild(GWNode('x : d')))
+            return t
+
+        for i in self.interpreters() :
+            i.profiler = Profiler(self.tickClock())
+            self.assertEquals(i.evalNode(site()),'abcendabcendd')
+            rows = dict([(r['name'],r) for r in i.profiler.rows()])
+            self.assertEquals((rows['outer']['calls'],rows['outer']['bytes'],rows['outer']['maxDepth']),(2,12,1))
+            self.assertEquals((rows['inner']['calls'],rows['inner']['bytes'],rows['inner']['maxDepth']),(3,7,2))
+            # each inner call takes one tick, and each outer call three, two of them its own
+            self.assertEquals((rows['outer']['inclusive'],rows['outer']['self']),(6,4))
+            self.assertEquals((rows['inner']['inclusive'],rows['inner']['self']),(3,3))
+        self.assertTrue('<td>outer</td>' in i.profiler.html())
+
+    def testProfilerWithFor(self) :
+        def site() :
+            t = GWNode('')
+            t.addChild(GWNode('::row').addChild('$x'))
+            t.addChild(GWNode('::table').addChild(GWNode(':for x ,, #__').addChild(GWNode(':row'))))
+            t.addChild(GWNode('&&html').addChild(GWNode(':table').addChild('a').addChild('bc')))
+            return t
+
+        for flame in [False, True] :
+            for i in self.interpreters() :
+                i.profiler = Profiler(self.tickClock(), flame)
+                self.assertEquals(i.evalNode(site()),'abc')
+                rows = dict([(r['name'],r) for r in i.profiler.rows()])
+                # the mode and the :for only show in the stacks
+                self.assertEquals(sorted(rows.keys()),['row','table'])
+                self.assertEquals((rows['table']['calls'],rows['table']['bytes'],rows['table']['maxDepth']),(1,3,1))
+                self.assertEquals((rows['row']['calls'],rows['row']['bytes'],rows['row']['maxDepth']),(2,3,2))
+                self.assertEquals((rows['row']['inclusive'],rows['row']['self']),(2,2))
+                # the :for's time is the table's own
+                if flame :
+                    self.assertEquals((rows['table']['inclusive'],rows['table']['self']),(9,7))
+                else :
+                    self.assertEquals((rows['table']['inclusive'],rows['table']['self']),(5,3))
+
+    def testFlameStacks(self) :
+        def site() :
+            t = GWNode('')
+            t.addChild(GWNode('::row').addChild('$x'))
+            t.addChild(GWNode('::table').addChild(GWNode(':for x ,, #__').addChild(GWNode(':row'))))
+            t.addChild(GWNode('&&html').addChild(GWNode(':table').addChild('a').addChild('bc')))
+            return t
+
+        for i in self.interpreters() :
+            i.profiler = Profiler(self.tickClock(), flame=True)
+            self.assertEquals(i.evalNode(site()),'abc')
+            # all the bytes are made by :row, the rest only pass them on
+            self.assertEquals(i.profiler.folded('bytes'),'&&html;:table;:for x;:row 3\n')
+            self.assertEquals(i.profiler.folded('time').split('\n'),
+                              ['&&html 2000000','&&html;:table 3000000','&&html;:table;:for x 4000000',
+                               '&&html;:table;:for x;:row 2000000',''])
+
+    def testStackEvaluator(self) :
+        def page() :
+            t = GWNode('')
+            t.addChild(GWNode('::blk').addChild(GWNode('.<b>').addChild('$who')))
+            t.addChild(GWNode('::list').addChild(GWNode('*items').addChild(GWNode(':for x ,, #__').addChild('$x'))))
+            t.addChild(GWNode('.<div class="x">').addChild(GWNode('=Title')).addChild(GWNode(':blk').addChild(GWNode('who : world'))))
+            t.addChild(GWNode(':list').addChild('a').addChild('b'))
+            t.addChild(GWNode(':*blk').addChild('one').addChild('two'))
+            t.addChild(GWNode('&&plaintext').addChild(GWNode('line').addChild('one').addChild('two')))
+            t.addChild(GWNode('&&ur').addChild(GWNode('u').addChild('v')))
+            t.addChild(GWNode('// gone').addChild('really'))
+            return t
+
+        def stack(i) :
+            i.evaluator = StackEvaluator()
+        i = self.assertSameOutput(page, stack)
+
+        # deeper than the recursive evaluator can go
+        deep = GWNode('')
+        n = deep
+        for x in range(2000) :
+            child = GWNode('.<i>')
+            n.addChild(child)
+            n = child
+        n.addChild('x')
+        self.assertEquals(i.evalNode(deep),'<i>' * 2000 + 'x' + '</i>' * 2000)
+        self.assertTrue(i.evaluator.deepest > 2000)
+
+        # and so are long chains of blocks calling blocks
+        chain = GWNode('')
+        for x in range(300) :
+            chain.addChild(GWNode('::c%s' % x).addChild(GWNode(':c%s' % (x+1))))
+        chain.addChild(GWNode('::c300').addChild('end'))
+        chain.addChild(GWNode(':c0'))
+        self.assertEquals(i.evalNode(chain),'end')
+
+        # errors still come out where they happened
+        self.assertRaises(SymbolTableException,i.evalNode,GWNode('').addChild(GWNode(':nosuchblock')))
+
+
+class TestTreeSync(unittest.TestCase) :
+
+    def testSync(self) :
+        import tempfile, shutil, os
+        d = tempfile.mkdtemp()
+        try :
+            src = os.path.join(d,'src')
+            dest = os.path.join(d,'dest')
+            os.makedirs(os.path.join(src,'img'))
+            for name, s in [('a.css','aaa'),('img/b.png','bb')] :
+                f = open(os.path.join(src,name),'w')
+                f.write(s)
+                f.close()
+
+            def sync(mode, useHash=False) :
+                ts = TreeSync(mode, useHash, threads=2)
+                ts.syncTree(src, dest)
+                return (ts.copied,ts.linked,ts.unchanged)
+
+            self.assertEquals(sync('copy'),(2,0,0))
+            self.assertEquals(sync('copy'),(0,0,2))
+            # the same content with another mtime is only copied without the hash
+            os.utime(os.path.join(dest,'a.css'),(1000,1000))
+            self.assertEquals(sync('copy',True),(0,0,2))
+            os.utime(os.path.join(dest,'a.css'),(1000,1000))
+            self.assertEquals(sync('copy'),(1,0,1))
+            # an edit of the same size, in the same second as the copy
+            f = open(os.path.join(src,'a.css'),'w')
+            f.write('xyz')
+            f.close()
+            mtime = os.stat(os.path.join(dest,'a.css')).st_mtime
+            os.utime(os.path.join(src,'a.css'),(mtime,int(mtime) + 0.9))
+            self.assertEquals(sync('copy'),(1,0,1))
+            self.assertEquals(open(os.path.join(dest,'a.css')).read(),'xyz')
+            self.assertEquals(sync('hardlink'),(0,2,0))
+            self.assertTrue(os.path.samefile(os.path.join(src,'a.css'),os.path.join(dest,'a.css')))
+            self.assertEquals(sync('symlink'),(0,2,0))
+            self.assertEquals(sync('symlink'),(0,0,2))
+            self.assertEquals(sync('copy'),(2,0,0))
+            self.assertFalse(os.path.islink(os.path.join(dest,'img','b.png')))
+            self.assertEquals(open(os.path.join(dest,'img','b.png')).read(),'bb')
+        finally :
+            shutil.rmtree(d)
+
+
+class TestWatch(unittest.TestCase) :
+
+    def testWatchers(self) :
+        import tempfile, shutil, os
+        d = tempfile.mkdtemp()
+        try :
+            src = os.path.join(d,'src.opml')
+            assets = os.path.join(d,'assets')
+            os.makedirs(assets)
+            def write(fName, s) :
+                f = open(fName,'w')
+                f.write(s)
+                f.close()
+            write(src,'one')
+            write(os.path.join(d,'other.txt'),'one')
+
+            watchers = [PollingWatcher(0.01,0.01)]
+            w = makeWatcher()
+            if w.__class__ is InotifyWatcher :
+                w.settle = 0.01
+                watchers.append(w)
+            for w in watchers :
+                w.watch([src,assets])
+                write(src,'two, and longer')
+                self.assertEquals(w.wait(),[src])
+                w.watch([src,assets])
+                write(os.path.join(assets,'new.css'),'x')
+                self.assertEquals(w.wait(),[os.path.join(assets,'new.css')])
+                w.close()
+        finally :
+            shutil.rmtree(d)
+
+
 class TestInterpreter(unittest.TestCase) :
 
     def buildInterpreter(self) :
@@ -785,6 +1374,129 @@ class TestInterpreter(unittest.TestCase) :
         self.assertEquals(i.modes['data'].__class__,DataMode)        
 
 
+    def testIncremental(self) :
+        import tempfile, shutil, os
+        d = tempfile.mkdtemp()
+
+        def build(hdr) :
+            i = self.buildInterpreter()
+            i.codedSiteRoot = 'root'
+            i.incremental = IncrementalBuild()
+            i.incremental.load(d)
+            i.evalNode(GWNode('').addChild(GWNode('::hdr').addChild(hdr)).addChild(GWNode('::body').addChild('B'))
+                       .addChild(GWNode('::stamp').addChild("!'S'")))
+            site = i.modes['staticSite']
+            for page in [GWNode('&one').addChild(':hdr'), GWNode('&two').addChild(':body'),
+                         GWNode('&three').addChild(GWNode('::local').addChild('L')).addChild(':local'),
+                         GWNode('&four').addChild(':stamp')] :
+                site.processPage(page, FellowTraveller(0,d,lambda x, y : x))
+            i.environment.siteMapper.writeAll()
+            i.incremental.save(d)
+            return i.incremental
+
+        def page(fName) :
+            f = open(os.path.join(d,fName))
+            s = f.read()
+            f.close()
+            return s
+
+        try :
+            self.assertEquals(build('H').rendered,4)
+            # the page which defines a block, and the one calling a block which runs python
+            inc = build('H')
+            self.assertEquals((inc.rendered,inc.skipped),(2,2))
+            inc = build('H2')
+            # and the page that calls :hdr
+            self.assertEquals((inc.rendered,inc.skipped),(3,1))
+            self.assertEquals((page('one.html'),page('two.html'),page('three.html'),page('four.html')),('H2','B','L','S'))
+            os.remove(os.path.join(d,'two.html'))
+            self.assertEquals(build('H2').rendered,3)
+            self.assertEquals(page('two.html'),'B')
+        finally :
+            shutil.rmtree(d)
+
+    def testKeepUnchanged(self) :
+        import tempfile, shutil, os
+        d = tempfile.mkdtemp()
+
+        def build(pages, streamed=[]) :
+            sm = SiteMapper(Logger())
+            sm.keepUnchanged = True
+            sm.prune = True
+            sm.load(d)
+            for fName, body in pages :
+                sm.add(d + '/site',fName,fName,body)
+            for fName, body in streamed :
+                out = sm.openPage(d + '/site',fName,fName)
+                out.write(body)
+                out.close()
+            sm.writeAll()
+            sm.finish()
+            return (sm.written,sm.unchanged,sm.deleted)
+
+        try :
+            self.assertEquals(build([('a.html','A'),('b.html','B')],[('c.html',u'C')]),(3,0,0))
+            hello = os.path.join(d,'site','a.html')
+            os.utime(hello,(1000,1000))
+            self.assertEquals(build([('a.html','A'),('b.html','B2')],[('c.html',u'C')]),(1,2,0))
+            self.assertEquals(os.stat(hello).st_mtime,1000)
+            self.assertEquals(build([('a.html','A')]),(0,1,2))
+            self.assertEquals(sorted(os.listdir(os.path.join(d,'site'))),['a.html'])
+        finally :
+            shutil.rmtree(d)
+
+    def testPagePool(self) :
+        def build(pagePool, effects=None) :
+            i = self.buildInterpreter()
+            i.codedSiteRoot = 'root'
+            i.pagePool = pagePool
+            i.blockMemo = BlockMemo()
+            i.evalNode(GWNode('').addChild(GWNode('::hdr').addChild('H')).addChild(GWNode('::py').addChild("!'py'")))
+            site = i.modes['staticSite']
+            for page in [GWNode('&one').addChild(':hdr'), GWNode('&two').addChild('2'),
+                         GWNode('&three').addChild(GWNode('::hdr').addChild('H3')),
+                         GWNode('&four').addChild(':hdr'), GWNode('&five').addChild(':py'), GWNode('&six').addChild('6'), GWNode('&seven').addChild(':hdr'),
+                         GWNode('&eight').addChild('$/nowhere/N/')] :
+                site.processPage(page, FellowTraveller(0,'ttest',lambda x, y : x))
+            site.flushPages()
+            if effects is not None :
+                memo = i.blockMemo
+                effects.extend([i.inputs, i.getSymbolTable().misses, (memo.hits, memo.misses, memo.uncached)])
+            return [(x[2],x[4]) for x in i.environment.siteMapper.list]
+
+        pool = PagePool(2)
+        # what the pages did in the workers comes back with them
+        inPool, inOrder = [], []
+        self.assertEquals(build(pool, inPool),build(None, inOrder))
+        self.assertEquals(inPool,inOrder)
+        self.assertEquals(inPool[1:],[{'nowhere' : 2},(1,2,1)])
+        self.assertEquals(build(None)[3],('four.html','H3'))
+        # three and five are rendered in order, after the pages before them
+        self.assertEquals((pool.parallel,pool.inOrder),(5,2))
+        self.assertEquals(build(pool)[6],('seven.html','H3'))
+        self.assertEquals(taskGroups(['a','a','a','b','a','c','c'],2),[[0,1],[5,6],[2],[3],[4]])
+
+    def testBulkWriter(self) :
+        import tempfile, shutil, os
+        d = tempfile.mkdtemp()
+        try :
+            w = BulkWriter(threads=2, queueSize=2, batchBytes=10)
+            names = [os.path.join(d,'%s.html' % x) for x in range(20)]
+            for x, name in enumerate(names) :
+                w.write(name, 'page %s' % x)
+            w.write(os.path.join(d,'big.html'), 'x' * 50)
+            w.close()
+            for x, name in enumerate(names) :
+                self.assertEquals(open(name).read(),'page %s' % x)
+            self.assertEquals(os.path.getsize(os.path.join(d,'big.html')),50)
+            self.assertEquals(w.files,21)
+            self.assertTrue(w.maxDepth <= 2)
+
+            w.write(os.path.join(d,'nowhere','x.html'), 'x')
+            self.assertRaises(IOError, w.close)
+        finally :
+            shutil.rmtree(d)
+
     def testSomeSimpleStuff(self) :
         t = GWNode('.<p>').addChild(GWNode('blah blah blah'))
         i = self.buildInterpreter()